@@ -1,32 +1,224 @@
-from flask import Flask, render_template, request, redirect, url_for, abort, send_file, session, jsonify, flash
+from flask import (Flask, render_template, request, redirect, url_for, abort, send_file, send_from_directory,
+                   session, jsonify, flash)
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text, case, cast, func, select, update, inspect, event, create_engine, tuple_, delete
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta
-from openpyxl.styles.builtins import percent
-from werkzeug.utils import secure_filename
-from fpdf import FPDF
-from docxtpl import DocxTemplate, InlineImage
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import ClientDisconnected
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import os
 import io
+import html
 import json
+import atexit
+import base64
+import copy
+import functools
+import click
+import logging
+import logging.handlers
+import mimetypes
+import multiprocessing.util
+import pathlib
+import queue
+import re
+import secrets
+import hashlib
+import heapq
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
 
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-key')
 
 
+class JsonLogFormatter(logging.Formatter):
+    """Uma linha JSON por registo, incluindo os campos passados em `extra=`."""
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        payload = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        payload.update({k: v for k, v in vars(record).items() if k not in self.RESERVED})
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+
+def configure_logging():
+    """Configura o logger `irp` a partir do ambiente.
+
+    LOG_LEVEL      nível base (INFO por omissão)
+    LOG_LEVELS     níveis por logger, ex.: "irp.progress=DEBUG,werkzeug=WARNING"
+    LOG_FORMAT     "text" (omissão) ou "json"
+    LOG_ASYNC      "1" para escrever através de uma fila numa thread própria
+    """
+    root = logging.getLogger('irp')
+    if root.handlers:
+        return root
+
+    handler = logging.StreamHandler()
+    if os.environ.get('LOG_FORMAT', 'text').lower() == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+
+    if os.environ.get('LOG_ASYNC') == '1':
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        handler = logging.handlers.QueueHandler(log_queue)
+
+    root.addHandler(handler)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    root.propagate = False
+
+    for item in os.environ.get('LOG_LEVELS', '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    return root
+
+
+log = configure_logging()
+progress_log = logging.getLogger('irp.progress')
+playbook_log = logging.getLogger('irp.playbook')
+upload_log = logging.getLogger('irp.uploads')
+report_log = logging.getLogger('irp.reports')
+
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 os.makedirs(os.path.join(app.root_path, 'reports'), exist_ok=True)
 
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SESSION_TYPE'] = 'filesystem'
+# Sessões no servidor (filesystem, sqlalchemy, redis) ou 'cookie' para o cookie assinado do Flask
+app.config['SESSION_TYPE'] = os.environ.get('SESSION_TYPE', 'filesystem')
+app.config['SESSION_FILE_DIR'] = os.environ.get('SESSION_FILE_DIR', os.path.join(app.root_path, 'flask_session'))
+app.config['SESSION_REDIS_URL'] = os.environ.get('SESSION_REDIS_URL')
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['SESSION_COOKIE_SECURE'] = False  # True se usares HTTPS
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'database.db')
+
+# Uploads: ficheiros grandes (capturas, dumps de memória) chegam em blocos via /incident/uploads
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_MB', '4096')) * 1024 * 1024
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_MB', '8')) * 1024 * 1024
+UPLOAD_READ_BLOCK = 1024 * 1024
+UPLOAD_SESSION_TTL = timedelta(hours=int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', '24')))
+# Limite do pedido inteiro (formulário simples ou bloco); a margem cobre os campos do multipart
+app.config['MAX_CONTENT_LENGTH'] = max(UPLOAD_MAX_BYTES, UPLOAD_CHUNK_BYTES) + 64 * 1024
+DEFAULT_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'database.db')
+
+
+def start_embedded_postgres():
+    """Arranca um PostgreSQL local (pgserver ou testing.postgresql); None se nenhum estiver instalado."""
+    try:
+        import pgserver
+        pgdata = os.environ.get('EMBEDDED_PGDATA') or os.path.join(basedir, 'instance', 'pgdata')
+        os.makedirs(os.path.dirname(pgdata), exist_ok=True)
+        server = pgserver.get_server(pgdata, cleanup_mode='stop')
+        return server.get_uri()
+    except ImportError:
+        pass
+    try:
+        import testing.postgresql
+        server = testing.postgresql.Postgresql()
+        atexit.register(server.stop)
+        return server.url()
+    except ImportError:
+        return None
+
+
+def resolve_database_uri():
+    """URI da base de dados a partir do ambiente.
+
+    DATABASE_URL aceita qualquer URI do SQLAlchemy (ex.: postgresql+psycopg://...);
+    "postgresql+embedded://" arranca um PostgreSQL local e, se não houver nenhum
+    disponível, volta ao ficheiro SQLite por omissão.
+    """
+    uri = os.environ.get('DATABASE_URL') or os.environ.get('SQLALCHEMY_DATABASE_URI')
+    if not uri:
+        return DEFAULT_DATABASE_URI
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    if uri.startswith('postgresql+embedded://'):
+        embedded = start_embedded_postgres()
+        if not embedded:
+            log.warning("PostgreSQL embebido indisponível (pgserver/testing.postgresql); a usar SQLite")
+            return DEFAULT_DATABASE_URI
+        return embedded
+    return uri
+
+
+app.config['SQLALCHEMY_DATABASE_URI'] = resolve_database_uri()
+
+# PRAGMAs aplicados a cada ligação SQLite nova (ver apply_sqlite_pragmas)
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', '-65536')),  # negativo = KiB
+    'temp_store': 'MEMORY',
+}
+
+
+def engine_options(uri):
+    if uri.startswith('sqlite') and (':memory:' in uri or uri.rstrip('/') == 'sqlite:'):
+        return {'connect_args': {'check_same_thread': False}}
+
+    options = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '20')),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', '30')),
+    }
+    if uri.startswith('sqlite'):
+        options['connect_args'] = {
+            'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000.0,
+            'check_same_thread': False,
+        }
+    else:
+        # Ligações de rede: validar antes de usar e reciclar antes dos timeouts do servidor/proxy
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+    return options
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 db = SQLAlchemy(app)
 
 
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None, pragmas=None):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in (pragmas if pragmas is not None else SQLITE_PRAGMAS).items():
+            cursor.execute(f'PRAGMA {name}={value}')
+    finally:
+        cursor.close()
+
+
 USERS = {
     'admin': 'senha123',
     'user': '123456'
@@ -39,128 +231,716 @@ STEPS_PATH = os.path.join(basedir, 'incident_steps.json')
 
 class Incident(db.Model):
     __tablename__ = 'incident'
+    __table_args__ = (
+        db.Index('ix_incident_status', 'status'),
+        db.Index('ix_incident_creation_date', 'creation_date'),
+        db.Index('ix_incident_start_datetime', 'start_datetime'),
+        # Paginação do dashboard: filtro por estado + ordenação por data, e filtro por classe/tipo
+        db.Index('ix_incident_status_start_datetime', 'status', 'start_datetime', 'id'),
+        db.Index('ix_incident_class_type', 'incident_class', 'incident_type'),
+        # Ids apagados não são reutilizados (uploads/ e relatórios estão chaveados pelo id)
+        {'sqlite_autoincrement': True},
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    incident_class = db.Column(db.String(100))
-    incident_type = db.Column(db.String(100))
-    steps = db.Column(db.Text)
-    sub_steps = db.Column(db.Text)
-    evidence = db.Column(db.Text)
-    attachments = db.Column(db.Text)
-    upload_status = db.Column(db.Boolean, default=False)
+    incident_class = db.mapped_column(db.String(100), active_history=True)
+    incident_type = db.mapped_column(db.String(100), active_history=True)
+    steps = db.Column(db.Text)  # snapshot JSON do playbook no momento da criação
     creation_date = db.Column(db.DateTime, default=datetime.utcnow)
-    status = db.Column(db.String(50), default='Completed')
+    # active_history: o resumo precisa do valor antigo mesmo com o atributo expirado
+    status = db.mapped_column(db.String(50), default='Completed', active_history=True)
     improvements = db.Column(db.Text)
     observations = db.Column(db.Text)
-    start_datetime = db.Column(db.DateTime, default=datetime.utcnow)
-    end_datetime = db.Column(db.DateTime, nullable=True)
+    start_datetime = db.mapped_column(db.DateTime, default=datetime.utcnow, active_history=True)
+    end_datetime = db.mapped_column(db.DateTime, nullable=True, active_history=True)
+    total_steps = db.Column(db.Integer, default=0)
+    completed_steps = db.Column(db.Integer, default=0)
+    percent_complete = db.Column(db.Float, default=0.0)
+
+
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+
+    version = db.Column(db.Integer, primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class IncidentSummary(db.Model):
+    """Contagens por (classe, tipo, estado), mantidas pelos eventos do Incident."""
+    __tablename__ = 'incident_summary'
+
+    incident_class = db.Column(db.String(100), primary_key=True)
+    incident_type = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.String(50), primary_key=True)
+    incident_count = db.Column(db.Integer, nullable=False, default=0)
+    # Incidentes com início e fim, e a soma das durações, para o tempo médio até fecho
+    closed_count = db.Column(db.Integer, nullable=False, default=0)
+    close_seconds = db.Column(db.Float, nullable=False, default=0.0)
+    # Fim anterior ao início (registos antigos): contados à parte, fora do tempo médio
+    invalid_dates_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ReportJob(db.Model):
+    """Pedido de geração de relatório; a tabela é a fila persistida dos workers."""
+    __tablename__ = 'report_job'
+    __table_args__ = (
+        db.Index('ix_report_job_status_created_at', 'status', 'created_at'),
+        db.Index('ix_report_job_incident_id', 'incident_id'),
+    )
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    incident_id = db.Column(db.Integer, db.ForeignKey('incident.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    engine = db.Column(db.String(20), default='docx')  # docx (LibreOffice) ou fpdf
+    output_path = db.Column(db.String(255))  # relativo a app.root_path
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+
+class UploadSession(db.Model):
+    """Upload em blocos ainda por terminar; o ficheiro parcial fica em upload_parts/<id>.part."""
+    __tablename__ = 'upload_session'
+    __table_args__ = (
+        db.Index('ix_upload_session_updated_at', 'updated_at'),
+    )
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    incident_id = db.Column(db.Integer, db.ForeignKey('incident.id'), nullable=False)
+    step_index = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ServerSession(db.Model):
+    """Conteúdo das sessões com SESSION_TYPE=sqlalchemy; o cookie só leva o id."""
+    __tablename__ = 'server_session'
+    __table_args__ = (
+        db.Index('ix_server_session_expires_at', 'expires_at'),
+    )
+
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+_MISSING = object()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Sessão guardada no servidor; só é gravada quando muda."""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.new = sid is None
+        self.expires_at = expires_at
+        self.modified = False
+
+    def __setitem__(self, key, value):
+        # Voltar a pôr o mesmo valor (as rotas fazem-no a cada pedido) não obriga a gravar
+        if dict.get(self, key, _MISSING) == value:
+            return
+        super().__setitem__(key, value)
+
+
+SESSION_ID_RE = re.compile(r'[A-Za-z0-9_-]{32,64}$')
+SESSION_PURGE_INTERVAL = 600  # segundos entre limpezas das sessões expiradas
+
+
+class SqlSessionStore:
+    """Sessões na base de dados da aplicação (SQLite ou PostgreSQL)."""
+
+    def __init__(self):
+        self._purged_at = 0.0
+
+    def load(self, sid):
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                select(ServerSession.data, ServerSession.expires_at)
+                .where(ServerSession.id == sid, ServerSession.expires_at > datetime.utcnow())
+            ).first()
+        return (row.data, row.expires_at) if row else None
+
+    def save(self, sid, data, expires_at):
+        table = ServerSession.__table__
+        with db.engine.begin() as connection:
+            upsert = DIALECT_UPSERT.get(connection.dialect.name)
+            if upsert is not None:
+                connection.execute(
+                    upsert(table).values(id=sid, data=data, expires_at=expires_at)
+                    .on_conflict_do_update(index_elements=[table.c.id],
+                                           set_={'data': data, 'expires_at': expires_at})
+                )
+            elif not connection.execute(
+                table.update().where(table.c.id == sid).values(data=data, expires_at=expires_at)
+            ).rowcount:
+                connection.execute(table.insert().values(id=sid, data=data, expires_at=expires_at))
+            if time.monotonic() - self._purged_at > SESSION_PURGE_INTERVAL:
+                self._purged_at = time.monotonic()
+                connection.execute(delete(table).where(table.c.expires_at <= datetime.utcnow()))
+
+    def delete(self, sid):
+        with db.engine.begin() as connection:
+            connection.execute(delete(ServerSession).where(ServerSession.id == sid))
+
+
+class FilesystemSessionStore:
+    """Um ficheiro por sessão; o nome é o hash do id, nunca o valor do cookie."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._purged_at = 0.0
+
+    def path(self, sid):
+        return os.path.join(self.directory, hashlib.sha256(sid.encode()).hexdigest())
+
+    def load(self, sid):
+        try:
+            with open(self.path(sid), encoding='utf-8') as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        expires_at = datetime.fromisoformat(entry['expires'])
+        if expires_at <= datetime.utcnow():
+            return None
+        return entry['data'], expires_at
+
+    def save(self, sid, data, expires_at):
+        path = self.path(sid)
+        partial_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(self.directory, exist_ok=True)  # só na primeira sessão gravada, não ao importar
+        with open(partial_path, 'w', encoding='utf-8') as fh:
+            json.dump({'expires': expires_at.isoformat(), 'data': data}, fh)
+        os.replace(partial_path, path)
+        if time.monotonic() - self._purged_at > SESSION_PURGE_INTERVAL:
+            self._purged_at = time.monotonic()
+            self.purge()
+
+    def delete(self, sid):
+        try:
+            os.remove(self.path(sid))
+        except FileNotFoundError:
+            pass
+
+    def purge(self):
+        # O mtime é a última gravação; expira um tempo de vida depois
+        cutoff = time.time() - app.permanent_session_lifetime.total_seconds()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+class LocalRedis:
+    """Substituto em memória de um cliente Redis (get/setex/delete), para correr sem servidor."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def setex(self, key, ttl, value):
+        ttl = ttl.total_seconds() if isinstance(ttl, timedelta) else ttl
+        with self._lock:
+            self._data[key] = (value.encode('utf-8') if isinstance(value, str) else value, time.monotonic() + ttl)
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+
+class RedisSessionStore:
+    """Sessões num Redis (ou num cliente compatível) com expiração pelo próprio TTL da chave."""
+
+    prefix = 'irp:session:'
+
+    def __init__(self, client):
+        self.client = client
+
+    def load(self, sid):
+        raw = self.client.get(self.prefix + sid)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        return entry['data'], datetime.fromisoformat(entry['expires'])
+
+    def save(self, sid, data, expires_at):
+        ttl = max(1, int((expires_at - datetime.utcnow()).total_seconds()))
+        self.client.setex(self.prefix + sid, ttl, json.dumps({'expires': expires_at.isoformat(), 'data': data}))
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+def redis_client(url):
+    """Cliente Redis para url; sem url (ou sem o pacote redis) usa o substituto em memória."""
+    if url:
+        try:
+            import redis
+            return redis.Redis.from_url(url)
+        except ImportError:
+            log.warning("Pacote redis não instalado; sessões num substituto em memória (só este processo)")
+    else:
+        log.info("SESSION_REDIS_URL não definido; sessões num substituto em memória (só este processo)")
+    return LocalRedis()
+
+
+class ServerSessionInterface(SessionInterface):
+    """Guarda a sessão num store do servidor; o cookie só leva um id opaco."""
+
+    serializer = TaggedJSONSerializer()
+    session_class = ServerSideSession
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and SESSION_ID_RE.match(sid):
+            try:
+                entry = self.store.load(sid)
+                if entry is not None:
+                    data, expires_at = entry
+                    return self.session_class(self.serializer.loads(data), sid=sid, expires_at=expires_at)
+            except Exception as e:
+                log.warning("Sessão %s… ilegível, a começar outra: %s", sid[:8], e)
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # make_session_permanent marca todos os pedidos com _permanent: sem mais nenhuma
+        # chave (visitante sem login) não há nada a gravar nem cookie a enviar
+        if not session.keys() - {'_permanent'}:
+            # Sessão esvaziada (logout): apagar no servidor e o cookie
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+            return
+
+        lifetime = app.permanent_session_lifetime
+        now = datetime.utcnow()
+        # Sem alterações só se volta a gravar quando já passou metade do tempo de vida
+        stale = session.expires_at is None or session.expires_at - now < lifetime / 2
+        if session.modified or stale:
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), now + lifetime)
+
+        if session.new or session.modified or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=httponly, domain=domain, path=path, secure=secure, samesite=samesite)
+
+
+def regenerate_session():
+    """Novo id de sessão (p.ex. no login), para que um id anterior não fique válido."""
+    if isinstance(session, ServerSideSession):
+        if not session.new:
+            app.session_interface.store.delete(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+        session.modified = True
+
+
+def create_session_interface(kind):
+    if kind == 'cookie':
+        return SecureCookieSessionInterface()
+    if kind == 'filesystem':
+        store = FilesystemSessionStore(app.config['SESSION_FILE_DIR'])
+    elif kind == 'sqlalchemy':
+        store = SqlSessionStore()
+    elif kind == 'redis':
+        store = RedisSessionStore(redis_client(app.config['SESSION_REDIS_URL']))
+    else:
+        raise ValueError(f"Unknown SESSION_TYPE: {kind}")
+    return ServerSessionInterface(store)
+
+
+app.session_interface = create_session_interface(app.config['SESSION_TYPE'])
+
+
+class Blob(db.Model):
+    """Conteúdo de anexo guardado uma única vez em blobs/, endereçado pelo SHA-256."""
+    __tablename__ = 'blob'
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)  # passos que usam o blob
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Attachment(db.Model):
+    """Ficheiro anexado a um passo: o conteúdo é um blob e path a ligação em uploads/."""
+    __tablename__ = 'attachment'
+    __table_args__ = (
+        db.Index('ix_attachment_incident_step', 'incident_id', 'step_index', 'uploaded_at'),
+        db.Index('ix_attachment_sha256', 'sha256'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    incident_id = db.Column(db.Integer, db.ForeignKey('incident.id'), nullable=False)
+    step_id = db.Column(db.Integer, db.ForeignKey('incident_step.id'), nullable=False)
+    step_index = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    path = db.Column(db.String(255), nullable=False)  # relativo a app.root_path
+    sha256 = db.Column(db.String(64))  # NULL se o ficheiro já não existia ao migrar
+    size = db.Column(db.BigInteger)
+    mime = db.Column(db.String(100))
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+_pillow = None
+
+
+def pillow():
+    """Módulos do Pillow, ou None se não estiver instalado (as imagens ficam como estão)."""
+    global _pillow
+    if _pillow is None:
+        try:
+            from PIL import Image, ImageOps
+            _pillow = (Image, ImageOps)
+        except ImportError:
+            log.info("Pillow indisponível: anexos usados sem versões reduzidas")
+            _pillow = False
+    return _pillow or None
+
+
+def attachment_metadata(path):
+    """Tamanho, tipo MIME e, nas imagens (com Pillow), dimensões do ficheiro."""
+    mime = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    metadata = {'size': os.path.getsize(path), 'mime': mime, 'width': None, 'height': None}
+    modules = pillow()
+    if modules is not None and mime.startswith('image/'):
+        try:
+            with modules[0].open(path) as image:  # só lê o cabeçalho
+                metadata['width'], metadata['height'] = image.size
+        except Exception:
+            pass
+    return metadata
+
+
+def step_attachments(incident_id):
+    """Anexos do incidente por step_index, pela ordem de upload."""
+    attachments = {}
+    rows = db.session.execute(
+        select(Attachment).where(Attachment.incident_id == incident_id)
+        .order_by(Attachment.step_index, Attachment.uploaded_at, Attachment.id)
+    ).scalars()
+    for attachment in rows:
+        attachments.setdefault(attachment.step_index, []).append(attachment)
+    return attachments
+
+
+class BlobStore:
+    """Anexos guardados uma vez por conteúdo em blobs/<aa>/<sha256>, com contagem de referências.
+
+    Os caminhos dos passos (uploads/<incidente>/step_<n>/<ficheiro>) são ligações físicas
+    para o blob, por isso os leitores existentes continuam a abrir ficheiros normais. Se o
+    sistema de ficheiros não suportar ligações, fica uma cópia.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tmp_dir = os.path.join(directory, 'tmp')
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def receive(self, stream):
+        """Grava o stream num temporário calculando o SHA-256 pelo caminho; devolve (sha256, tamanho, temporário)."""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                for block in iter(lambda: stream.read(UPLOAD_READ_BLOCK), b''):
+                    sha.update(block)
+                    target.write(block)
+                    size += len(block)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return sha.hexdigest(), size, tmp_path
+
+    def acquire(self, connection, sha256, size):
+        """Mais uma referência ao blob (cria a linha se for novo); o commit é de quem chama."""
+        table = Blob.__table__
+        upsert = DIALECT_UPSERT.get(connection.dialect.name)
+        if upsert is not None:
+            connection.execute(
+                upsert(table).values(sha256=sha256, size=size, refcount=1, created_at=datetime.utcnow())
+                .on_conflict_do_update(index_elements=[table.c.sha256], set_={'refcount': table.c.refcount + 1})
+            )
+            return
+        result = connection.execute(
+            table.update().where(table.c.sha256 == sha256).values(refcount=table.c.refcount + 1)
+        )
+        if not result.rowcount:
+            connection.execute(table.insert().values(sha256=sha256, size=size, refcount=1,
+                                                     created_at=datetime.utcnow()))
+
+    def place(self, source_path, sha256):
+        """Põe o conteúdo no blob (só um rename); se já existir, o source é descartado."""
+        target = self.path(sha256)
+        if os.path.exists(target):
+            os.remove(source_path)
+            return target
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source_path, target)
+        return target
+
+    def link(self, sha256, target):
+        """Cria target como ligação física ao blob, substituindo o que lá estiver."""
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial_path = f'{target}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.link(self.path(sha256), partial_path)
+        except OSError:
+            shutil.copyfile(self.path(sha256), partial_path)
+        os.replace(partial_path, target)
+
+    def release(self, sha256s):
+        """Larga uma referência a cada blob e apaga os que ficarem sem nenhuma."""
+        table = Blob.__table__
+        sha256s = [sha256 for sha256 in sha256s if sha256]
+        if not sha256s:
+            return
+        for sha256 in sha256s:
+            db.session.execute(table.update().where(table.c.sha256 == sha256)
+                               .values(refcount=table.c.refcount - 1))
+        db.session.commit()
+        self.collect(set(sha256s))
+
+    def collect(self, sha256s=None):
+        """Apaga blobs sem referências; devolve quantos foram removidos."""
+        table = Blob.__table__
+        query = select(table.c.sha256).where(table.c.refcount <= 0)
+        if sha256s is not None:
+            query = query.where(table.c.sha256.in_(sha256s))
+        removed = 0
+        for sha256 in db.session.execute(query).scalars().all():
+            result = db.session.execute(delete(table).where(table.c.sha256 == sha256, table.c.refcount <= 0))
+            db.session.commit()
+            if result.rowcount != 1:
+                continue
+            # Um upload concorrente pode ter voltado a criar a linha (e posto o ficheiro) entretanto:
+            # o blob é primeiro afastado e só é apagado se a linha continuar a não existir
+            path = self.path(sha256)
+            doomed = f'{path}.{uuid.uuid4().hex}.gc'
+            try:
+                os.replace(path, doomed)
+            except FileNotFoundError:
+                continue
+            if db.session.get(Blob, sha256, populate_existing=True) is not None:
+                os.replace(doomed, path)
+            else:
+                os.remove(doomed)
+                removed += 1
+            db.session.rollback()
+        return removed
+
+
+blob_store = BlobStore(os.path.join(app.root_path, 'blobs'))
+
+
+SUMMARY_ATTRS = ('incident_class', 'incident_type', 'status', 'start_datetime', 'end_datetime')
+SUMMARY_COUNTERS = ('incident_count', 'closed_count', 'close_seconds', 'invalid_dates_count')
+DIALECT_UPSERT = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+
+def summary_entry(incident_class, incident_type, status, start_datetime, end_datetime):
+    """Chave do resumo e contribuição (incidentes, fechados, segundos, datas inválidas) de um incidente."""
+    key = (incident_class or '', incident_type or '', status or '')
+    if start_datetime is None or end_datetime is None:
+        return key, (1, 0, 0.0, 0)
+    seconds = (end_datetime - start_datetime).total_seconds()
+    if seconds < 0:
+        return key, (1, 0, 0.0, 1)
+    return key, (1, 1, seconds, 0)
+
+
+def bump_summary(connection, key, deltas):
+    incident_class, incident_type, status = key
+    counters = dict(zip(SUMMARY_COUNTERS, deltas))
+    table = IncidentSummary.__table__
+    values = {name: table.c[name] + delta for name, delta in counters.items()}
+    upsert = DIALECT_UPSERT.get(connection.dialect.name)
+    if upsert is not None:
+        connection.execute(
+            upsert(table)
+            .values(incident_class=incident_class, incident_type=incident_type, status=status, **counters)
+            .on_conflict_do_update(index_elements=list(table.primary_key.columns), set_=values)
+        )
+        return
+
+    # Outros motores: UPDATE e, se a linha ainda não existir, INSERT
+    result = connection.execute(
+        table.update()
+        .where(table.c.incident_class == incident_class, table.c.incident_type == incident_type,
+               table.c.status == status)
+        .values(**values)
+    )
+    if not result.rowcount:
+        connection.execute(table.insert().values(
+            incident_class=incident_class, incident_type=incident_type, status=status, **counters
+        ))
+
+
+def previous_value(target, name):
+    history = inspect(target).attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    # Alterado sem valor antigo registado: o valor antigo era NULL
+    return None if history.added else getattr(target, name)
+
+
+@event.listens_for(Incident, 'after_insert')
+def summary_after_insert(mapper, connection, target):
+    key, deltas = summary_entry(*(getattr(target, name) for name in SUMMARY_ATTRS))
+    bump_summary(connection, key, deltas)
+
+
+@event.listens_for(Incident, 'after_update')
+def summary_after_update(mapper, connection, target):
+    old_key, old_deltas = summary_entry(*(previous_value(target, name) for name in SUMMARY_ATTRS))
+    new_key, new_deltas = summary_entry(*(getattr(target, name) for name in SUMMARY_ATTRS))
+    if (old_key, old_deltas) == (new_key, new_deltas):
+        return
+    bump_summary(connection, old_key, tuple(-d for d in old_deltas))
+    bump_summary(connection, new_key, new_deltas)
+
+
+@event.listens_for(Incident, 'after_delete')
+def summary_after_delete(mapper, connection, target):
+    key, deltas = summary_entry(*(previous_value(target, name) for name in SUMMARY_ATTRS))
+    bump_summary(connection, key, tuple(-d for d in deltas))
+
+
+def rebuild_incident_summary(connection):
+    """Reconstrói o resumo a partir da tabela incident (migração e reparação)."""
+    totals = {}
+    rows = connection.execute(select(*(getattr(Incident, name) for name in SUMMARY_ATTRS)))
+    for row in rows:
+        key, deltas = summary_entry(*row)
+        current = totals.get(key, (0, 0, 0.0, 0))
+        totals[key] = tuple(a + b for a, b in zip(current, deltas))
+
+    connection.execute(IncidentSummary.__table__.delete())
+    if totals:
+        connection.execute(IncidentSummary.__table__.insert(), [
+            {'incident_class': key[0], 'incident_type': key[1], 'status': key[2],
+             **dict(zip(SUMMARY_COUNTERS, deltas))}
+            for key, deltas in totals.items()
+        ])
+    return len(totals)
+
+
+def step_is_complete(evidence, sub_steps, has_attachment):
+    """Um passo está completo com evidência, pelo menos um sub-passo e um anexo."""
+    try:
+        has_substeps = bool(json.loads(sub_steps or '[]'))
+    except (ValueError, TypeError):
+        has_substeps = False
+    return bool((evidence or '').strip() and has_substeps and has_attachment)
 
 
 class IncidentStep(db.Model):
+    """Estado de um passo; classe, tipo, playbook e progresso vivem no Incident."""
+
     __tablename__ = 'incident_step'
+    __table_args__ = (
+        db.Index('ux_incident_step_incident_step_index', 'incident_id', 'step_index', unique=True),
+        db.Index('ix_incident_step_start_datetime', 'start_datetime'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     incident_id = db.Column(db.Integer, db.ForeignKey('incident.id'), nullable=False, default=1)
-    steps = db.Column(db.String(100))
     step_index = db.Column(db.Integer)
-    incident_class = db.Column(db.String(100))
-    incident_type = db.Column(db.String(100))
     evidence = db.Column(db.Text)
     sub_steps = db.Column(db.Text)
-    attachment_name = db.Column(db.String(255))
     upload_status = db.Column(db.Boolean, default=False)
     start_datetime = db.Column(db.DateTime, default=datetime.utcnow)
-    improvements = db.Column(db.Text)
-    observations = db.Column(db.Text)
-    percent_complete = db.Column(db.Float, default=0.0)
-    status = db.Column(db.String(50), default='In Progress')
+    completed = db.Column(db.Boolean, default=False)
 
     incident = db.relationship('Incident', backref=db.backref('steps_data', lazy=True))
 
+    def evaluate_completed(self):
+        return step_is_complete(self.evidence, self.sub_steps, self.has_attachments())
+
+    def has_attachments(self):
+        return db.session.execute(
+            select(Attachment.id).where(Attachment.incident_id == self.incident_id,
+                                        Attachment.step_index == self.step_index).limit(1)
+        ).first() is not None
+
     @staticmethod
     def recalc_incident_progress(incident_id):
         """Recalcula e atualiza status do Incident."""
-        inc = Incident.query.get(incident_id)
-        if not inc:
-            return
-        pct = inc.progress_percentage()
+        pct = recompute_incident_progress(incident_id)
         if pct == 100.0:
+            inc = db.session.get(Incident, incident_id)
             inc.status = 'Completed'
             inc.end_datetime = datetime.utcnow()
         db.session.commit()
         return pct
 
-    def get_ordered_step_keys(self):
-        try:
-            steps = json.loads(self.steps or '[]')
-            return [str(i + 1) for i in range(len(steps))]
-        except Exception:
-            return []
-
-    def update_next_incomplete_step(self):
-        sub_steps = json.loads(self.sub_steps or '{}')
-        evidence = json.loads(self.evidence or '{}')
-        attachments = json.loads(self.attachments or '{}')
-        ordered_steps = self.get_ordered_step_keys()  # ['1', '2', '3', ...]
-
-        for step in ordered_steps:
-            has_substeps = len(sub_steps.get(step, [])) > 0
-            has_evidence = len(evidence.get(step, '').strip()) > 0
-            has_attachment = len(attachments.get(step, [])) > 0
-
-            if not (has_substeps and has_evidence and has_attachment):
-                self.current_step = step
-                db.session.add(self)
-                db.session.commit()
-
-                return
-
-        self.current_step = None  # Tudo completo
-        db.session.add(self)
-        db.session.commit()
-
-    def is_complete(self):
-        sub_steps = json.loads(self.sub_steps or '{}')
-        evidence = json.loads(self.evidence or '{}')
-        attachments = json.loads(self.attachments or '{}')
-        ordered_steps = self.get_ordered_step_keys()
-
-        for step in ordered_steps:
-            if not (
-                len(sub_steps.get(step, [])) > 0 and
-                len(evidence.get(step, '').strip()) > 0 and
-                len(attachments.get(step, [])) > 0
-            ):
-                return False
-        return True
-
     def get_next_step_from_data(self):
-        try:
-            step_keys = self.get_ordered_step_keys()  # Ex: ['1', '2', '3', ...]
-
-            for step_index in step_keys:
-                step = IncidentStep.query.filter_by(incident_id=self.id, step_index=step_index).first()
-
-                # Verifica se o step está ausente ou incompleto
-                if not step or not (
-                        step.evidence and step.sub_steps and step.attachment_name and
-                        step.sub_steps != '[]' and step.attachment_name.strip() != ''
-                ):
-                    return int(step_index)  # Retorna o índice do primeiro step incompleto
+        incident = self.incident or db.session.get(Incident, self.incident_id)
+        if not incident:
+            return None
+        step_rows = IncidentStep.query.filter_by(incident_id=incident.id).all()
+        return IncidentStep.next_incomplete_step(incident, step_rows)
 
-            # Todos os steps estão completos, verifica se falta lições aprendidas
-            if not (self.improvements and self.observations):
-                return "lessons_learned"
+    @staticmethod
+    def next_incomplete_step(incident, step_rows):
+        """Primeiro passo por completar, a partir das linhas já carregadas (sem queries extra)."""
+        completed = {row.step_index for row in step_rows if row.completed}
+        for step_index in range(1, (incident.total_steps or 0) + 1):
+            if step_index not in completed:
+                return step_index
 
-            # Tudo completo
-            return None
+        # Todos os steps estão completos, verifica se falta lições aprendidas
+        if not (incident.improvements and incident.observations):
+            return "lessons_learned"
 
-        except Exception as e:
-            print("Erro ao identificar próximo passo com base nos dados:", e)
-            return None
+        # Tudo completo
+        return None
 
     @staticmethod
     def restore_incident_to_session(incident, session):
+        """Só a identificação do incidente fica na sessão; o estado dos passos lê-se da BD (working_state)."""
         session['incident_id'] = incident.id
         session['start_datetime'] = (
             incident.start_datetime.isoformat()
@@ -171,21 +951,23 @@ class IncidentStep(db.Model):
         session['class'] = incident.incident_class
         session['type'] = incident.incident_type
 
-        # Restaurar os títulos dos steps
+        return IncidentStep.query.filter_by(incident_id=incident.id).all()
+
+    @staticmethod
+    def working_state(incident):
+        """Títulos, evidências, sub-passos e anexos dos passos do incidente, por step_index (str)."""
         try:
             steps_data = json.loads(incident.steps or '[]')
-            session['steps'] = [step.get('title', f'Step {i + 1}') for i, step in enumerate(steps_data)]
+            titles = [step.get('step') or step.get('title', f'Step {i + 1}') for i, step in enumerate(steps_data)]
         except json.JSONDecodeError:
-            session['steps'] = []
-
-        # Restaurar os IncidentStep específicos do incidente
-        step_data = IncidentStep.query.filter_by(incident_id=incident.id).all()
+            titles = []
 
+        files = step_attachments(incident.id)
         evidence = {}
         sub_steps = {}
         attachments = {}
 
-        for sd in step_data:
+        for sd in IncidentStep.query.filter_by(incident_id=incident.id):
             # Usar step_index para chavear cada passo individualmente
             idx = str(getattr(sd, 'step_index', None) or sd.id)  # fallback para id se step_index não existir
 
@@ -198,133 +980,710 @@ class IncidentStep(db.Model):
                 except json.JSONDecodeError:
                     sub_steps[idx] = []
 
-            if sd.attachment_name:
-                attachments[idx] = [sd.attachment_name]  # em lista, como esperado no template
+            if sd.step_index in files:
+                attachments[idx] = [attachment.path for attachment in files[sd.step_index]]
 
-        session['evidence'] = evidence
-        session['sub_steps'] = sub_steps
-        session['attachments'] = attachments
+        return {'steps': titles, 'evidence': evidence, 'sub_steps': sub_steps, 'attachments': attachments}
 
-        session.modified = True
 
+def playbook_key(incident_class, incident_type):
+    return (incident_class or '').strip().casefold(), (incident_type or '').strip().casefold()
 
-def load_incidents():
-    with open(INCIDENTS_PATH, 'r', encoding='utf-8') as f:
-        return json.load(f)
 
+class PlaybookEntry:
+    """Passos de um par (classe, tipo), com o número de passos já calculado."""
 
-def load_incident_steps():
-    with open(STEPS_PATH, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    __slots__ = ('incident_class', 'incident_type', 'steps', 'step_count')
 
+    def __init__(self, incident_class, incident_type, steps):
+        self.incident_class = incident_class
+        self.incident_type = incident_type
+        self.steps = steps
+        self.step_count = len(steps)
 
-with app.app_context():
-    db.create_all()
 
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+SEARCH_MIN_NGRAM = 2
 
 
-def progress_calculation(incident_id):
-    percent_complete = compute_percent_complete(incident_id)
-    return jsonify({'status': 'ok', 'percent_complete': percent_complete})
+def search_tokens(text):
+    return SEARCH_TOKEN_RE.findall((text or '').casefold())
 
 
+class PlaybookSearchIndex:
+    """Índice invertido dos playbooks (classes, tipos, passos e sub-passos).
 
-def compute_percent_complete(incident_id):
-    try:
-        # Obter um dos steps para saber a classe/tipo
-        base_step = IncidentStep.query.filter_by(incident_id=incident_id).first()
-        if not base_step:
-            print(f"[Progresso] Incidente {incident_id} não encontrado.")
-            return 0.0
-
-        incident_class = (base_step.incident_class or "").strip().lower()
-        incident_type = (base_step.incident_type or "").strip().lower()
-
-        # Carregar os passos definidos para a classe+tipo
-        all_steps = load_incident_steps()
-        selected_steps = []
-        for item in all_steps:
-            if item.get('class', '').strip().lower() == incident_class:
-                for type_item in item.get('types', []):
-                    if type_item.get('type', '').strip().lower() == incident_type:
-                        selected_steps = type_item.get('steps', [])
-                        break
-                break
+    Cada token é indexado por todos os seus prefixos (edge n-grams) com pelo
+    menos SEARCH_MIN_NGRAM caracteres, para que palavras incompletas também
+    encontrem resultados enquanto o utilizador escreve.
+    """
+
+    KIND_WEIGHTS = {'class': 4.0, 'type': 3.0, 'step': 2.0, 'substep': 1.0}
+
+    def __init__(self, incidents, steps):
+        self.documents = []
+        self.postings = {}
+        self._seen = set()
+
+        for item in incidents:
+            self._add('class', {'class': item['class']}, item['class'])
+            for type_item in item['types']:
+                self._add('type', {'class': item['class'], 'type': type_item['type']}, type_item['type'])
+
+        for item in steps:
+            class_name = item['class']
+            self._add('class', {'class': class_name}, class_name)
+            for type_item in item['types']:
+                type_name = type_item['type']
+                self._add('type', {'class': class_name, 'type': type_name}, type_name)
+                for step in type_item['steps']:
+                    self._add('step', {'class': class_name, 'type': type_name, 'step': step['step']}, step['step'])
+                    for sub in step['sub_steps']:
+                        self._add('substep', {'class': class_name, 'type': type_name, 'substep': sub}, sub)
+
+        del self._seen
+
+    def _add(self, kind, result, text):
+        key = tuple(sorted(result.items()))
+        if key in self._seen:
+            return
+        self._seen.add(key)
+
+        doc_id = len(self.documents)
+        self.documents.append((self.KIND_WEIGHTS[kind], result))
+
+        for token in set(search_tokens(text)):
+            for n in range(SEARCH_MIN_NGRAM, len(token) + 1):
+                bucket = self.postings.setdefault(token[:n], {})
+                # Palavra completa pesa mais do que um prefixo
+                weight = 2.0 if n == len(token) else 1.0
+                if bucket.get(doc_id, 0.0) < weight:
+                    bucket[doc_id] = weight
+
+    def search(self, query, limit=20, offset=0):
+        """Devolve (total, resultados) ordenados por relevância; todos os termos têm de coincidir."""
+        tokens = [t for t in search_tokens(query) if len(t) >= SEARCH_MIN_NGRAM]
+        if not tokens:
+            return 0, []
+
+        scores = None
+        for token in tokens:
+            bucket = self.postings.get(token)
+            if not bucket:
+                return 0, []
+            if scores is None:
+                scores = dict(bucket)
+            else:
+                scores = {doc_id: score + bucket[doc_id] for doc_id, score in scores.items() if doc_id in bucket}
+            if not scores:
+                return 0, []
+
+        ranked = heapq.nsmallest(
+            offset + limit,
+            scores.items(),
+            key=lambda item: (-item[1] * self.documents[item[0]][0], item[0])
+        )
+        return len(scores), [self.documents[doc_id][1] for doc_id, _ in ranked[offset:]]
 
-        total_steps = len(selected_steps)
-        if total_steps == 0:
-            print(f"[Progresso] Incidente {incident_id} sem passos definidos.")
-            return 0.0
 
-        # Obter todos os registos dos passos do incidente
-        step_rows = {str(s.step_index): s for s in IncidentStep.query.filter_by(incident_id=incident_id).all()}
+class PlaybookSnapshot:
+    """Cópia imutável dos playbooks, tal como lida do disco num dado momento."""
+
+    def __init__(self, signature, incidents, steps):
+        self.signature = signature
+        self.incidents = incidents
+        self.steps = steps
+        self.loaded_at = datetime.utcnow()
+        self.index = self._build_index(steps)
+        self.search_index = PlaybookSearchIndex(incidents, steps)
+
+    @staticmethod
+    def _build_index(steps):
+        index = {}
+        for item in steps:
+            for type_item in item['types']:
+                key = playbook_key(item['class'], type_item['type'])
+                # Em caso de duplicados mantém-se a primeira ocorrência
+                index.setdefault(key, PlaybookEntry(item['class'], type_item['type'], type_item['steps']))
+        return index
+
+    def lookup(self, incident_class, incident_type):
+        return self.index.get(playbook_key(incident_class, incident_type))
+
+
+class PlaybookCatalog:
+    """Catálogo em memória de incidents.json e incident_steps.json.
+
+    Os ficheiros são lidos uma única vez por processo; só voltam a ser lidos
+    quando o mtime/tamanho muda (verificado no máximo a cada
+    `check_interval` segundos) ou quando `reload()` é chamado explicitamente.
+    """
+
+    def __init__(self, incidents_path, steps_path, check_interval=2.0):
+        self.incidents_path = incidents_path
+        self.steps_path = steps_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0.0
+
+    def _signature(self):
+        signature = []
+        for path in (self.incidents_path, self.steps_path):
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    @staticmethod
+    def _read_json(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _normalize_incidents(raw):
+        incidents = []
+        for item in raw or []:
+            incidents.append({
+                'class': (item.get('class') or '').strip(),
+                'types': [{'type': (t.get('type') or '').strip()} for t in item.get('types', [])]
+            })
+        return incidents
+
+    @staticmethod
+    def _normalize_steps(raw):
+        # Algumas versões do ficheiro vêm embrulhadas numa lista extra
+        if len(raw or []) == 1 and isinstance(raw[0], list):
+            raw = raw[0]
+
+        classes = []
+        for item in raw or []:
+            types = []
+            for type_item in item.get('types', []):
+                steps = [
+                    {'step': step.get('step', ''), 'sub_steps': list(step.get('sub_steps', []))}
+                    for step in type_item.get('steps', [])
+                ]
+                types.append({'type': (type_item.get('type') or '').strip(), 'steps': steps})
+            classes.append({'class': (item.get('class') or '').strip(), 'types': types})
+        return classes
+
+    def _build(self, signature):
+        return PlaybookSnapshot(
+            signature=signature,
+            incidents=self._normalize_incidents(self._read_json(self.incidents_path)),
+            steps=self._normalize_steps(self._read_json(self.steps_path))
+        )
 
-        completed = 0
-        for i in range(1, total_steps + 1):
-            key = str(i)
-            step = step_rows.get(key)
+    def snapshot(self):
+        snap = self._snapshot
+        now = time.monotonic()
+        if snap is not None and now - self._checked_at < self.check_interval:
+            return snap
 
-            ev_ok = bool(step and step.evidence and step.evidence.strip())
-            subs_ok = False
+        with self._lock:
+            snap = self._snapshot
+            if snap is not None and now - self._checked_at < self.check_interval:
+                return snap
             try:
-                subs_data = json.loads(step.sub_steps or "[]") if step else []
-                subs_ok = bool(subs_data)
-            except Exception:
-                pass
+                signature = self._signature()
+                if snap is None or snap.signature != signature:
+                    snap = self._build(signature)
+                    playbook_log.info("Playbooks carregados: %d classes, %d tipos", len(snap.steps), len(snap.index))
+                    # Troca atómica: quem já tem o snapshot antigo continua a usá-lo
+                    self._snapshot = snap
+            except (OSError, ValueError) as e:
+                if snap is None:
+                    raise
+                playbook_log.warning("Falha ao recarregar playbooks, mantendo versão anterior: %s", e)
+            self._checked_at = now
+            return snap
+
+    def reload(self):
+        with self._lock:
+            snap = self._build(self._signature())
+            self._snapshot = snap
+            self._checked_at = time.monotonic()
+            return snap
+
+    def lookup(self, incident_class, incident_type):
+        return self.snapshot().lookup(incident_class, incident_type)
+
+    @property
+    def incidents(self):
+        return self.snapshot().incidents
+
+    @property
+    def steps(self):
+        return self.snapshot().steps
+
+
+playbook_catalog = PlaybookCatalog(
+    INCIDENTS_PATH,
+    STEPS_PATH,
+    check_interval=float(os.environ.get('PLAYBOOK_CHECK_INTERVAL', '2'))
+)
 
-            attach_ok = bool(step and step.attachment_name and step.attachment_name.strip())
 
-            if ev_ok and subs_ok and attach_ok:
-                completed += 1
+def load_incidents():
+    return playbook_catalog.incidents
+
+
+def load_incident_steps():
+    return playbook_catalog.steps
+
+
+# Índices FTS5 sobre o texto histórico (evidências e lições aprendidas),
+# sincronizados por triggers para não depender de cada rota que escreve.
+HISTORY_FTS_SCHEMA = {
+    'incident_step_fts': (
+        'incident_step', ('evidence',)
+    ),
+    'incident_fts': (
+        'incident', ('improvements', 'observations')
+    ),
+}
 
-            print(f"Step {i}: evidence={'✅' if ev_ok else '❌'}, sub_steps={'✅' if subs_ok else '❌'}, attachment={'✅' if attach_ok else '❌'}")
 
-        # 50% base de progresso por passos
-        step_progress = (completed / total_steps) * 50.0
+def history_fts_ddl(fts_table, source_table, columns):
+    cols = ', '.join(columns)
+    new_cols = ', '.join(f'new.{c}' for c in columns)
+    old_cols = ', '.join(f'old.{c}' for c in columns)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5("
+        f"{cols}, content='{source_table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {source_table} BEGIN "
+        f"INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.id, {new_cols}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {source_table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {cols} ON {source_table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); "
+        f"INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.id, {new_cols}); END",
+    ]
 
-        # 25% por observações + 25% por melhorias
-        extra_progress = 0.0
-        if any((s.observations or "").strip() for s in step_rows.values()):
-            extra_progress += 25.0
-        if any((s.improvements or "").strip() for s in step_rows.values()):
-            extra_progress += 25.0
 
-        percent = round(step_progress + extra_progress, 2)
-        print(f"[Progresso] Incidente {incident_id}: {completed}/{total_steps} passos completos — {percent}% completo.")
-        return percent
+def history_tsvector(alias, columns):
+    return "to_tsvector('simple', " + " || ' ' || ".join(f"coalesce({alias}.{c}, '')" for c in columns) + ")"
 
+
+def init_history_search():
+    """Prepara a pesquisa no histórico: FTS5 no SQLite, índices GIN no PostgreSQL.
+
+    Devolve False se o motor não suportar pesquisa de texto integral.
+    """
+    dialect = db.engine.dialect.name
+    try:
+        with db.engine.begin() as conn:
+            for fts_table, (source_table, columns) in HISTORY_FTS_SCHEMA.items():
+                if dialect == 'postgresql':
+                    conn.execute(text(
+                        f"CREATE INDEX IF NOT EXISTS ix_{source_table}_fulltext ON {source_table} "
+                        f"USING gin ({history_tsvector(source_table, columns)})"
+                    ))
+                    continue
+                if dialect != 'sqlite':
+                    return False
+
+                exists = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                    {'name': fts_table}
+                ).first()
+                for statement in history_fts_ddl(fts_table, source_table, columns):
+                    conn.execute(text(statement))
+                if not exists:
+                    # Primeira vez: indexar as linhas que já existem
+                    conn.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"))
     except Exception as e:
-        print(f"[Erro] Falha ao calcular progresso do incidente {incident_id}: {e}")
-        return 0.0
+        log.warning("Pesquisa de texto integral indisponível, pesquisa no histórico desativada: %s", e)
+        return False
+    return True
+
+
+def history_search_enabled():
+    """True se o init-db criou os índices de texto; verificado uma vez por processo."""
+    enabled = app.config.get('HISTORY_SEARCH_ENABLED')
+    if enabled is None:
+        inspector = inspect(db.engine)
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            enabled = all(inspector.has_table(fts_table) for fts_table in HISTORY_FTS_SCHEMA)
+        elif dialect == 'postgresql':
+            enabled = all(
+                f'ix_{source_table}_fulltext' in {index['name'] for index in inspector.get_indexes(source_table)}
+                for source_table, _ in HISTORY_FTS_SCHEMA.values()
+            )
+        else:
+            enabled = False
+        app.config['HISTORY_SEARCH_ENABLED'] = enabled
+    return enabled
 
 
+def add_missing_columns(connection):
+    """create_all() não altera tabelas existentes; acrescenta as colunas novas dos modelos."""
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
 
 
+def table_columns(connection, table):
+    return {column['name'] for column in inspect(connection).get_columns(table)}
 
 
-@app.route('/incident/<int:incident_id>/second_download')
-def second_download_report(incident_id):
-    path = os.path.join(app.root_path, 'relatorios', f'incident_{incident_id}.pdf')
+def backfill_total_steps(connection):
+    """total_steps a partir do snapshot do playbook; sem snapshot, do catálogo atual."""
+    for row in connection.execute(text("SELECT id, incident_class, incident_type, steps FROM incident")).all():
+        try:
+            total = len(json.loads(row.steps)) if row.steps else 0
+        except (ValueError, TypeError):
+            total = 0
+        if not total:
+            entry = playbook_catalog.lookup(row.incident_class, row.incident_type)
+            total = entry.step_count if entry else 0
+        connection.execute(
+            text("UPDATE incident SET total_steps = :total WHERE id = :id"),
+            {'total': total, 'id': row.id}
+        )
 
-    if not os.path.exists(path):
-        return '', 404 if request.method == 'HEAD' else abort(404)
 
-    if request.method == 'HEAD':
-        return '', 200
+def migrate_0001_incident_progress(connection):
+    # Incidentes antigos só existiam como linhas de IncidentStep. Sem incident_class a
+    # tabela já foi criada com o esquema normalizado (0003) e não há nada a copiar.
+    if 'incident_class' in table_columns(connection, 'incident_step'):
+        connection.execute(text("""
+            INSERT INTO incident (id, incident_class, incident_type, steps, status, creation_date, start_datetime)
+            SELECT s.incident_id, max(s.incident_class), max(s.incident_type), max(s.steps),
+                   'In Progress', min(s.start_datetime), min(s.start_datetime)
+            FROM incident_step s
+            LEFT JOIN incident i ON i.id = s.incident_id
+            WHERE i.id IS NULL
+            GROUP BY s.incident_id
+        """))
+
+    backfill_total_steps(connection)
+
+    # Sem attachment_name a tabela foi criada já com os anexos em attachment (0007)
+    step_columns = table_columns(connection, 'incident_step')
+    attachment_column = 'attachment_name' if 'attachment_name' in step_columns else 'NULL AS attachment_name'
+    rows = connection.execute(
+        text(f"SELECT id, evidence, sub_steps, {attachment_column} FROM incident_step")
+    ).all()
+    for row in rows:
+        connection.execute(
+            text("UPDATE incident_step SET completed = :done WHERE id = :id"),
+            {'done': step_is_complete(row.evidence, row.sub_steps, (row.attachment_name or '').strip()), 'id': row.id}
+        )
+
+    recompute_incident_progress(connection=connection)
+
+
+def migrate_0002_indexes(connection):
+    # Antes do índice único: manter a linha mais antiga de cada (incident_id, step_index),
+    # que era a devolvida pelos .first() das rotas
+    connection.execute(text("""
+        DELETE FROM incident_step
+        WHERE step_index IS NOT NULL AND EXISTS (
+            SELECT 1 FROM incident_step older
+            WHERE older.incident_id = incident_step.incident_id
+              AND older.step_index = incident_step.step_index
+              AND older.id < incident_step.id
+        )
+    """))
+    for table in (Incident.__table__, IncidentStep.__table__):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+# Colunas que deixaram de existir com o esquema normalizado
+LEGACY_STEP_COLUMNS = ('steps', 'incident_class', 'incident_type', 'improvements', 'observations',
+                       'percent_complete', 'status')
+LEGACY_INCIDENT_COLUMNS = ('sub_steps', 'evidence', 'attachments', 'upload_status')
+
+
+def migrate_0003_normalize_steps(connection):
+    step_columns = table_columns(connection, 'incident_step')
+
+    # Metadados e lições aprendidas passam a existir só no Incident
+    for column in ('incident_class', 'incident_type', 'steps', 'improvements', 'observations'):
+        if column in step_columns:
+            connection.execute(text(f"""
+                UPDATE incident SET {column} = (
+                    SELECT max(s.{column}) FROM incident_step s WHERE s.incident_id = incident.id
+                )
+                WHERE {column} IS NULL OR {column} = ''
+            """))
+
+    # Os índices de texto dependem das colunas removidas; init_history_search recria-os
+    if connection.dialect.name == 'sqlite':
+        for suffix in ('ai', 'ad', 'au'):
+            connection.execute(text(f'DROP TRIGGER IF EXISTS incident_step_fts_{suffix}'))
+        connection.execute(text('DROP TABLE IF EXISTS incident_step_fts'))
+    connection.execute(text('DROP INDEX IF EXISTS ix_incident_step_fulltext'))
+    connection.execute(text('DROP INDEX IF EXISTS ix_incident_step_status'))
+
+    for column in LEGACY_STEP_COLUMNS:
+        if column in step_columns:
+            connection.execute(text(f'ALTER TABLE incident_step DROP COLUMN {column}'))
+
+    incident_columns = table_columns(connection, 'incident')
+    for column in LEGACY_INCIDENT_COLUMNS:
+        if column in incident_columns:
+            connection.execute(text(f'ALTER TABLE incident DROP COLUMN {column}'))
+
+    # A 0001 contou os passos pelo catálogo quando o Incident ainda não tinha snapshot;
+    # agora que o snapshot veio dos passos, total e concluídos saem dele
+    backfill_total_steps(connection)
+    recompute_incident_progress(connection=connection)
+
+
+def migrate_0004_dashboard_keyset(connection):
+    # A paginação por (start_datetime, id) não lida com NULLs; usar a data de criação
+    connection.execute(
+        update(Incident)
+        .where(Incident.start_datetime.is_(None))
+        .values(start_datetime=func.coalesce(Incident.creation_date, func.current_timestamp()))
+    )
+    for index in Incident.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def migrate_0005_incident_summary(connection):
+    rebuild_incident_summary(connection)
+
+
+def migrate_0006_attachment_blobs(connection):
+    # Anexos já existentes passam para o blob store; ficheiros repetidos ficam uma só cópia
+    step_columns = table_columns(connection, 'incident_step')
+    if 'attachment_name' not in step_columns:
+        return
+    if 'attachment_sha256' not in step_columns:
+        connection.execute(text('ALTER TABLE incident_step ADD COLUMN attachment_sha256 VARCHAR(64)'))
+    rows = connection.execute(text(
+        "SELECT id, attachment_name FROM incident_step "
+        "WHERE attachment_name IS NOT NULL AND attachment_sha256 IS NULL"
+    )).all()
+    for step_id, attachment_name in rows:
+        path = os.path.join(app.root_path, attachment_name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as fh:
+            sha256, size, tmp_path = blob_store.receive(fh)
+        blob_store.place(tmp_path, sha256)
+        blob_store.link(sha256, path)
+        blob_store.acquire(connection, sha256, size)
+        connection.execute(text("UPDATE incident_step SET attachment_sha256 = :sha256 WHERE id = :id"),
+                           {'sha256': sha256, 'id': step_id})
+
+
+def migrate_0007_attachments(connection):
+    # O anexo único de cada passo (incident_step.attachment_name) passa para a tabela attachment
+    step_columns = table_columns(connection, 'incident_step')
+    if 'attachment_name' not in step_columns:
+        return
+    rows = connection.execute(text(
+        "SELECT id, incident_id, step_index, attachment_name, attachment_sha256, start_datetime "
+        "FROM incident_step WHERE attachment_name IS NOT NULL AND attachment_name <> ''"
+    ).columns(start_datetime=db.DateTime)).all()
+    for row in rows:
+        path = os.path.join(app.root_path, row.attachment_name)
+        exists = os.path.isfile(path)
+        metadata = attachment_metadata(path) if exists else {'mime': mimetypes.guess_type(path)[0]}
+        connection.execute(Attachment.__table__.insert().values(
+            incident_id=row.incident_id, step_id=row.id, step_index=row.step_index,
+            filename=os.path.basename(row.attachment_name), path=row.attachment_name,
+            sha256=row.attachment_sha256 if exists else None,
+            uploaded_at=row.start_datetime or datetime.utcnow(), **metadata
+        ))
+    for column in ('attachment_name', 'attachment_sha256'):
+        connection.execute(text(f'ALTER TABLE incident_step DROP COLUMN {column}'))
+
+
+def migrate_0008_summary_invalid_dates(connection):
+    # Incidentes com fim anterior ao início passam a ser contados à parte, fora do tempo médio
+    rebuild_incident_summary(connection)
+
+
+MIGRATIONS = [
+    (1, migrate_0001_incident_progress),
+    (2, migrate_0002_indexes),
+    (3, migrate_0003_normalize_steps),
+    (4, migrate_0004_dashboard_keyset),
+    (5, migrate_0005_incident_summary),
+    (6, migrate_0006_attachment_blobs),
+    (7, migrate_0007_attachments),
+    (8, migrate_0008_summary_invalid_dates),
+]
+
+
+def migrate_db():
+    # Numa base de dados nova o create_all() já cria o esquema final; as migrações só são registadas
+    fresh = not inspect(db.engine).has_table(Incident.__tablename__)
+    db.create_all()
+    with db.engine.begin() as connection:
+        add_missing_columns(connection)
+        applied = set(connection.execute(select(SchemaVersion.version)).scalars())
+        for version, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            if not fresh:
+                migration(connection)
+            connection.execute(SchemaVersion.__table__.insert().values(version=version, applied_at=datetime.utcnow()))
+
+        if connection.dialect.name == 'postgresql':
+            # As migrações inserem ids explícitos; a sequence tem de ficar à frente deles
+            for table in ('incident', 'incident_step'):
+                connection.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table}"
+                ))
+
+
+
+
+def progress_calculation(incident_id):
+    percent_complete = compute_percent_complete(incident_id)
+    return jsonify({'status': 'ok', 'percent_complete': percent_complete})
+
+
+
+def progress_expression(completed_steps):
+    """Expressão SQL do progresso: 50% pelos passos, 25% observações, 25% melhorias."""
+    step_progress = case(
+        (Incident.total_steps > 0, completed_steps * 50.0 / Incident.total_steps),
+        else_=0.0
+    )
+    lessons_progress = (
+        case((func.coalesce(func.trim(Incident.observations), '') != '', 25.0), else_=0.0) +
+        case((func.coalesce(func.trim(Incident.improvements), '') != '', 25.0), else_=0.0)
+    )
+    # round(x, n) só existe para numeric no PostgreSQL
+    return func.round(cast(step_progress + lessons_progress, db.Numeric(5, 2)), 2)
+
+
+def compute_percent_complete(incident_id):
+    percent = db.session.execute(
+        select(Incident.percent_complete).where(Incident.id == incident_id)
+    ).scalar()
+    return percent or 0.0
+
+
+def sync_step_completion(step):
+    """Atualiza o bit de conclusão do passo e, se mudou, o progresso do incidente.
+
+    O progresso é ajustado com um único UPDATE na linha do Incident, sem voltar a
+    ler os restantes passos. Devolve a nova percentagem, ou None se nada mudou.
+    """
+    done = step.evaluate_completed()
+    if step.id is None:
+        db.session.flush()
+
+    # O bit muda com um UPDATE condicional: de dois saves sobrepostos do mesmo passo,
+    # que leram ambos o valor antigo, só um altera a linha e só esse mexe no contador
+    flipped = db.session.execute(
+        update(IncidentStep)
+        .where(IncidentStep.id == step.id, func.coalesce(IncidentStep.completed, False) != done)
+        .values(completed=done)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+    set_committed_value(step, 'completed', done)
+    if not flipped or not step.step_index or step.step_index < 1:
+        return None
+
+    completed_steps = func.coalesce(Incident.completed_steps, 0) + (1 if done else -1)
+    percent = db.session.execute(
+        update(Incident)
+        .where(Incident.id == step.incident_id, Incident.total_steps >= step.step_index)
+        .values(completed_steps=completed_steps, percent_complete=progress_expression(completed_steps))
+        .returning(Incident.percent_complete)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    progress_log.debug("Incidente %s, passo %s: completo=%s, progresso=%s%%",
+                       step.incident_id, step.step_index, done, percent)
+    return percent
+
+
+def recompute_incident_progress(incident_id=None, connection=None):
+    """Recalcula o progresso a partir dos passos (migrações e lições aprendidas)."""
+    completed_steps = (
+        select(func.count(IncidentStep.id))
+        .where(
+            IncidentStep.incident_id == Incident.id,
+            IncidentStep.completed.is_(True),
+            IncidentStep.step_index.between(1, Incident.total_steps)
+        )
+        .correlate(Incident)
+        .scalar_subquery()
+    )
+    stmt = update(Incident).values(
+        completed_steps=completed_steps,
+        percent_complete=progress_expression(completed_steps)
+    )
+    if incident_id is not None:
+        stmt = stmt.where(Incident.id == incident_id).returning(Incident.percent_complete)
+
+    if connection is not None:
+        connection.execute(stmt)
+        return None
+
+    result = db.session.execute(stmt.execution_options(synchronize_session=False))
+    return (result.scalar() or 0.0) if incident_id is not None else None
+
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+
+
+def init_db():
+    """Cria ou migra o esquema e os índices de pesquisa. Corre com `flask init-db`, não no import."""
+    migrate_db()
+    app.config['HISTORY_SEARCH_ENABLED'] = init_history_search()
+
 
-    return send_file(path, as_attachment=True, download_name=f'incident_{incident_id}.pdf')
+@app.cli.command('init-db')
+def init_db_command():
+    """Cria ou migra o esquema da base de dados; correr antes de arrancar os workers."""
+    init_db()
+    versions = db.session.execute(select(func.max(SchemaVersion.version))).scalar()
+    click.echo(f'database ready at schema version {versions}')
+
+
+@app.route('/incident/<int:incident_id>/second_download')
+def second_download_report(incident_id):
+    return download_incident(incident_id)
 
 
 @app.route('/incident/delete/<int:incident_id>', methods=['POST'])
 def delete_incident(incident_id):
     try:
-        # Remove associated steps
+        # Remove associated steps, report jobs and their cached PDFs
+        blob_refs = db.session.execute(
+            select(Attachment.sha256).where(Attachment.incident_id == incident_id)
+        ).scalars().all()
+        Attachment.query.filter_by(incident_id=incident_id).delete()
         IncidentStep.query.filter_by(incident_id=incident_id).delete()
+        report_paths = db.session.execute(
+            select(ReportJob.output_path).where(ReportJob.incident_id == incident_id).distinct()
+        ).scalars().all()
+        ReportJob.query.filter_by(incident_id=incident_id).delete()
+        upload_ids = db.session.execute(
+            select(UploadSession.id).where(UploadSession.incident_id == incident_id)
+        ).scalars().all()
+        UploadSession.query.filter_by(incident_id=incident_id).delete()
 
         # Remove incident
         incident = Incident.query.get_or_404(incident_id)
         db.session.delete(incident)
         db.session.commit()
+        report_store.discard(path for path in report_paths if path)
+        for upload_id in upload_ids:
+            discard_partial_upload(upload_id)
+        # Anexos: as ligações do incidente saem e os blobs que ficam sem referências são apagados
+        shutil.rmtree(os.path.join(app.root_path, 'uploads', str(incident_id)), ignore_errors=True)
+        blob_store.release(blob_refs)
 
         return jsonify({'status': 'success'})
 
@@ -347,40 +1706,215 @@ def login():
     password = request.form.get('password')
 
     if username in USERS and USERS[username] == password:
+        regenerate_session()
         session['username'] = username
         return redirect(url_for('dashboard'))
     message = 'Incorrect user or password!'
     return render_template('index.html', message=message)
 
 
+# Ordenações do dashboard: coluna principal e se é descendente. O id desempata sempre.
+DASHBOARD_SORTS = {
+    'newest': (Incident.start_datetime, True),
+    'oldest': (Incident.start_datetime, False),
+    'id': (Incident.id, False),
+    'id_desc': (Incident.id, True),
+}
+DASHBOARD_STATUSES = ('In Progress', 'Completed')
+DASHBOARD_PAGE_SIZE = 25
+
+
+def encode_cursor(values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """Devolve os valores da chave do cursor, ou None se for inválido para esta ordenação."""
+    if not cursor:
+        return None
+    column = DASHBOARD_SORTS[sort][0]
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if column is Incident.id:
+            return (int(values[0]),)
+        return datetime.fromisoformat(values[0]), int(values[1])
+    except (ValueError, TypeError, IndexError, KeyError):
+        return None
+
+
+def date_arg(value):
+    try:
+        return datetime.strptime((value or '').strip(), '%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def dashboard_filters(args):
+    filters = {
+        'class': (args.get('class') or '').strip(),
+        'type': (args.get('type') or '').strip(),
+        'status': args.get('status') if args.get('status') in DASHBOARD_STATUSES else '',
+        'from': date_arg(args.get('from')),
+        'to': date_arg(args.get('to')),
+    }
+    sort = args.get('sort')
+    return filters, sort if sort in DASHBOARD_SORTS else 'newest'
+
+
+def incident_page(filters, sort, after=None, limit=DASHBOARD_PAGE_SIZE):
+    """Uma página de incidentes por keyset: custo constante, independente do tamanho do histórico.
+
+    Devolve (incidentes, cursor da página seguinte ou None).
+    """
+    column, descending = DASHBOARD_SORTS[sort]
+    keys = (Incident.id,) if column is Incident.id else (column, Incident.id)
+
+    stmt = select(Incident)
+    if filters['status']:
+        stmt = stmt.where(Incident.status == filters['status'])
+    if filters['class']:
+        stmt = stmt.where(Incident.incident_class == filters['class'])
+    if filters['type']:
+        stmt = stmt.where(Incident.incident_type == filters['type'])
+    if filters['from']:
+        stmt = stmt.where(Incident.start_datetime >= filters['from'])
+    if filters['to']:
+        stmt = stmt.where(Incident.start_datetime < filters['to'] + timedelta(days=1))
+
+    position = decode_cursor(after, sort)
+    if position:
+        key, value = tuple_(*keys), tuple_(*position)
+        stmt = stmt.where(key < value if descending else key > value)
+
+    stmt = stmt.order_by(*(k.desc() if descending else k.asc() for k in keys)).limit(limit + 1)
+    incidents = db.session.execute(stmt).scalars().all()
+
+    next_cursor = None
+    if len(incidents) > limit:
+        incidents = incidents[:limit]
+        last = incidents[-1]
+        next_cursor = encode_cursor([getattr(last, k.key) for k in keys])
+    return incidents, next_cursor
+
+
+def incident_summary(incident):
+    return {
+        'id': incident.id,
+        'class': incident.incident_class,
+        'type': incident.incident_type,
+        'status': incident.status,
+        'start_datetime': incident.start_datetime.isoformat() if incident.start_datetime else None,
+        'end_datetime': incident.end_datetime.isoformat() if incident.end_datetime else None,
+        'percent_complete': incident.percent_complete or 0.0,
+    }
+
+
+def dashboard_kpis():
+    """KPIs do dashboard lidos do resumo: dezenas de linhas, independente do histórico."""
+    rows = db.session.execute(select(IncidentSummary).where(IncidentSummary.incident_count > 0)).scalars().all()
+
+    by_status = {}
+    closed = seconds = invalid_dates = 0
+    breakdown = []
+    for row in rows:
+        by_status[row.status] = by_status.get(row.status, 0) + row.incident_count
+        closed += row.closed_count
+        seconds += row.close_seconds
+        invalid_dates += row.invalid_dates_count or 0
+        breakdown.append({
+            'class': row.incident_class,
+            'type': row.incident_type,
+            'status': row.status,
+            'count': row.incident_count,
+            'mean_time_to_close_seconds': round(row.close_seconds / row.closed_count, 1) if row.closed_count else None
+        })
+
+    return {
+        'total': sum(by_status.values()),
+        'in_progress': by_status.get('In Progress', 0),
+        'completed': by_status.get('Completed', 0),
+        'by_status': by_status,
+        'mean_time_to_close_seconds': round(seconds / closed, 1) if closed else None,
+        'invalid_dates': invalid_dates,
+        'by_class_type': sorted(breakdown, key=lambda item: (item['class'], item['type'], item['status']))
+    }
+
+
+def format_duration(seconds):
+    # Sem incidentes fechados, ou uma média negativa de dados inválidos: nada a mostrar
+    if seconds is None or seconds < 0:
+        return '—'
+    days, rest = divmod(int(seconds), 86400)
+    hours, rest = divmod(rest, 3600)
+    if days:
+        return f'{days}d {hours}h'
+    return f'{hours}h {rest // 60}m'
+
+
+@app.route('/dashboard/summary')
+def dashboard_summary():
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(dashboard_kpis())
+
+
 @app.route('/dashboard')
 def dashboard():
     if 'username' not in session:
         return redirect(url_for('index'))
 
-    # Apresenta apenas 1 por incidente
-    in_progress_incidents = (
-        db.session.query(IncidentStep)
-        .filter(IncidentStep.status != 'Completed')
-        .order_by(IncidentStep.id.asc())
-        .all()
-    )
+    filters, sort = dashboard_filters(request.args)
+    limit = int_arg(request.args.get('limit'), DASHBOARD_PAGE_SIZE, 1, 100)
 
-    completed_incidents = (
-        db.session.query(Incident)
-        .filter(Incident.status == 'Completed')
-        .order_by(Incident.id.asc())
-        .all()
-    )
+    if request.args.get('format') == 'json':
+        incidents, next_cursor = incident_page(filters, sort, request.args.get('after'), limit)
+        return jsonify({
+            'incidents': [incident_summary(i) for i in incidents],
+            'next_cursor': next_cursor,
+            'sort': sort,
+            'limit': limit
+        })
+
+    # Cada secção tem o seu próprio cursor (in_progress_after / completed_after)
+    sections = {}
+    for status in DASHBOARD_STATUSES:
+        if filters['status'] and filters['status'] != status:
+            continue
+        key = status.lower().replace(' ', '_')
+        section_filters = dict(filters, status=status)
+        sections[key] = incident_page(section_filters, sort, request.args.get(f'{key}_after'), limit)
+
+    in_progress_incidents, in_progress_next = sections.get('in_progress', ([], None))
+    completed_incidents, completed_next = sections.get('completed', ([], None))
+
+    def page_url(**cursor):
+        # Mantém filtros, ordenação e o cursor da outra secção
+        return url_for('dashboard', **dict(request.args.items(), **cursor))
+
+    kpis = dashboard_kpis()
 
     return render_template(
         'dashboard.html',
+        kpis=kpis,
+        mean_time_to_close=format_duration(kpis['mean_time_to_close_seconds']),
         in_progress_incidents=in_progress_incidents,
-        completed_incidents=completed_incidents
+        completed_incidents=completed_incidents,
+        in_progress_next_url=page_url(in_progress_after=in_progress_next) if in_progress_next else None,
+        completed_next_url=page_url(completed_after=completed_next) if completed_next else None,
+        filters=dict(filters, **{
+            'from': filters['from'].strftime('%Y-%m-%d') if filters['from'] else '',
+            'to': filters['to'].strftime('%Y-%m-%d') if filters['to'] else '',
+        }),
+        sort=sort,
+        sorts=DASHBOARD_SORTS,
+        statuses=DASHBOARD_STATUSES,
+        incident_classes=load_incidents(),
+        first_page_url=url_for('dashboard', **{k: v for k, v in request.args.items() if not k.endswith('_after')})
+        if any(k.endswith('_after') for k in request.args) else None
     )
 
 
-
 @app.route('/incident', methods=['GET', 'POST'])
 def incident():
     if 'username' not in session:
@@ -410,29 +1944,23 @@ def incident():
 
 @app.route('/incident/resume/<int:incident_id>')
 def resume_incident(incident_id):
-    incident = IncidentStep.query.get(incident_id)
+    incident = db.session.get(Incident, incident_id)
     if not incident:
         flash("Incident not found.", "warning")
         return redirect(url_for('dashboard'))
 
-    IncidentStep.restore_incident_to_session(incident, session)
-    step = IncidentStep.query.filter_by(incident_id=incident.id).first()
-
-    if not step:
+    # As linhas carregadas para a sessão chegam para descobrir o próximo passo
+    step_rows = IncidentStep.restore_incident_to_session(incident, session)
+    if not step_rows:
         flash("Incident step data missing.", "danger")
         return redirect(url_for('dashboard'))
 
-    next_step = step.get_next_step_from_data()
+    next_step = IncidentStep.next_incomplete_step(incident, step_rows)
     if next_step is None or next_step == "lessons_learned":
         flash("All steps are completed!" if next_step is None else "", "info")
         return redirect(url_for('complete', incident_id=incident.id))
 
-    try:
-        step_id = int(next_step)
-        return redirect(url_for('step_view', step_id=step_id, incident_id=incident.id))
-    except (ValueError, TypeError):
-        flash("Invalid next step format.", "danger")
-        return redirect(url_for('dashboard'))
+    return redirect(url_for('step_view', step_id=next_step, incident_id=incident.id))
 
 
 @app.route('/incident/<int:incident_id>/step/<int:step_id>', methods=['GET'])
@@ -440,7 +1968,7 @@ def step_view(incident_id, step_id):
     if 'username' not in session:
         return redirect(url_for('index'))
 
-    incident = db.session.get(IncidentStep, incident_id)
+    incident = db.session.get(Incident, incident_id)
     if not incident:
         flash("Incident not found.", "warning")
         return redirect(url_for('dashboard'))
@@ -449,14 +1977,16 @@ def step_view(incident_id, step_id):
     if session.get('incident_id') != incident_id:
         IncidentStep.restore_incident_to_session(incident, session)
 
-    steps_titles = session.get('steps', [])
+    state = IncidentStep.working_state(incident)
+    steps_titles = state['steps']
+    # Sub-passos vêm do snapshot do playbook gravado no próprio incidente
     try:
-        sub_steps_list = json.loads(incident.sub_steps or '[]')
-    except (ValueError, TypeError):
+        sub_steps_list = [step.get('sub_steps', []) for step in json.loads(incident.steps or '[]')]
+    except (ValueError, TypeError, AttributeError):
         sub_steps_list = []
 
-    evidence = session.get('evidence', {})
-    attachments = session.get('attachments', {})
+    evidence = state['evidence']
+    attachments = state['attachments']
 
     steps = []
     for idx, title in enumerate(steps_titles):
@@ -464,15 +1994,13 @@ def step_view(incident_id, step_id):
         steps.append({'step': title, 'sub_steps': substeps_for_step})
         break
 
-    # Extract first file from attachments per step
-    existing_files = {k: v[0] for k, v in attachments.items() if isinstance(v, list) and v}
+    existing_files = {k: v for k, v in attachments.items() if isinstance(v, list) and v}
 
     # Incident properties, fallback to None if missing
     class_ = getattr(incident, 'incident_class')
     type_ = getattr(incident, 'incident_type')
 
-    # `percent` is not defined here in original, assuming 0 or calculate if needed
-    percent = getattr(incident, 'percent_complete', 0)
+    percent = incident.percent_complete or 0.0
 
     return render_template(
         'steps.html',
@@ -498,20 +2026,11 @@ def steps():
     if not class_param or not type_param:
         abort(400, description="Missing 'class' or 'type' in session.")
 
-    all_steps_data = load_incident_steps()
-    if len(all_steps_data) == 1 and isinstance(all_steps_data[0], list):
-        all_steps_data = all_steps_data[0]
-
-    found_steps = []
-    for item in all_steps_data:
-        if item.get('class', '').strip().lower() == class_param.strip().lower():
-            for type_item in item.get('types', []):
-                if type_item.get('type', '').strip().lower() == type_param.strip().lower():
-                    found_steps = type_item.get('steps', [])
-                    break
-            break
+    entry = playbook_catalog.lookup(class_param, type_param)
+    found_steps = entry.steps if entry else []
+    total_steps = entry.step_count if entry else 0
 
-    session['total_steps'] = len(found_steps)
+    session['total_steps'] = total_steps
 
     incident_id = session.get('incident_id')
 
@@ -521,36 +2040,38 @@ def steps():
             incident_id = None
 
     if not incident_id:
-        last = IncidentStep.query.order_by(IncidentStep.incident_id.desc()).first()
-        next_id = (last.incident_id + 1) if last else 1
         now = datetime.utcnow()
-
-        incident_id = session.get('incident_id')
-
         start_step_index = 1
 
         try:
-            new_incident = IncidentStep(
-                incident_id=next_id,
-                step_index=start_step_index,
+            incident_row = Incident(
                 incident_class=class_param,
                 incident_type=type_param,
                 steps=json.dumps(found_steps),
+                status="In Progress",
                 start_datetime=now,
-                status="In Progress"
+                total_steps=total_steps,
+                completed_steps=0,
+                percent_complete=0.0
             )
-            db.session.add(new_incident)
+            db.session.add(incident_row)
+            # O id vem do autoincrement do Incident, atribuído dentro desta transação
+            db.session.flush()
+
+            db.session.add_all([
+                IncidentStep(incident_id=incident_row.id, step_index=step_index, start_datetime=now)
+                for step_index in range(start_step_index, max(total_steps, 1) + 1)
+            ])
             db.session.commit()
 
-
             # Atualiza sessão com os dados essenciais
             session.update({
-                'incident_id': next_id,
+                'incident_id': incident_row.id,
                 'start_datetime': now.isoformat(),
                 'class': class_param,
                 'type': type_param
             })
-            incident_id = next_id
+            incident_id = incident_row.id
             session.modified = True
 
         except Exception as e:
@@ -565,6 +2086,7 @@ def steps():
     evidence = {}
     sub_steps = {}
     existing_files = {}
+    files = step_attachments(incident_id)
 
     for row in step_rows:
         idx = str(row.step_index)
@@ -573,38 +2095,19 @@ def steps():
             sub_steps[idx] = json.loads(row.sub_steps or "[]")
         except json.JSONDecodeError:
             sub_steps[idx] = []
-        existing_files[idx] = (row.attachment_name or "").strip()
+        existing_files[idx] = [attachment.path for attachment in files.get(row.step_index, [])]
 
     saved_indices = [int(k) for k, v in evidence.items() if v]
     start_index = max(saved_indices) if saved_indices else 0
 
-    completed_count = sum(
-        1 for idx in range(len(found_steps))
-        if str(idx) in evidence and evidence[str(idx)]
-        and str(idx) in sub_steps and sub_steps[str(idx)]
-        and str(idx) in existing_files and existing_files[str(idx)]
-    )
-
-    total_steps = len(found_steps)
-    step_progress = round((completed_count / total_steps) * 50.0, 1) if total_steps else 0.0
-
-    observations = any((s.observations or "").strip() for s in step_rows)
-    improvements = any((s.improvements or "").strip() for s in step_rows)
-    lessons_progress = (25.0 if observations else 0.0) + (25.0 if improvements else 0.0)
-
-    percent = round(step_progress + lessons_progress, 1)
-
-    for row in step_rows:
-        row.percent_complete = percent
-    db.session.commit()
+    percent = compute_percent_complete(incident_id)
 
     session['session_inprogress'] = str(incident_id)
     session['start'] = session.get('start') or step_rows[0].start_datetime.isoformat()
-    session.modified = True
 
     return render_template(
         'steps.html',
-        incident=step_rows[0],
+        incident=db.session.get(Incident, incident_id),
         steps=found_steps,
         class_=class_param,
         type_=type_param,
@@ -647,8 +2150,6 @@ def save_step():
     if not isinstance(checked_substeps, list):
         return jsonify({'error': 'Invalid substeps format'}), 400
 
-    attachment_name = data.get('attachment_name', '').strip()
-
     try:
         step = IncidentStep.query.filter_by(incident_id=incident_id, step_index=step_index).first()
         if not step:
@@ -656,23 +2157,16 @@ def save_step():
 
         step.evidence = evidence_text
         step.sub_steps = json.dumps(checked_substeps)
-        if attachment_name:
-            step.attachment_name = attachment_name
 
+        percent = sync_step_completion(step)
         db.session.commit()
 
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'Database error: {str(e)}'}), 500
 
-    percent = compute_percent_complete(incident_id)
-    try:
-        for s in IncidentStep.query.filter_by(incident_id=incident_id).all():
-            s.percent_complete = percent
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': f'Progress update failed: {str(e)}'}), 500
+    if percent is None:
+        percent = compute_percent_complete(incident_id)
 
     return jsonify(status="ok", percent=percent)
 
@@ -698,28 +2192,12 @@ def save_completion():
     if not improvements or not observations:
         return jsonify({'error': 'All fields must be filled'}), 400
 
-    # Datas
-    start_time = session.get('start')
-    if isinstance(start_time, str):
-        try:
-            start_time = datetime.fromisoformat(start_time)
-        except ValueError:
-            start_time = datetime.now()
-    elif not start_time:
-        start_time = datetime.now()
+    # Datas em UTC, como o start_datetime gravado na criação (que não é reescrito aqui)
+    end_time = datetime.utcnow()
 
-    end_time = datetime.now()
-    session['end'] = end_time
-
-    # Lessons learned
-    session['lessons'] = {
-        'improvements': improvements,
-        'observations': observations
-    }
-
-    incident_id = session.get('id')
+    incident_id = session.get('incident_id') or session.get('id')
     if not incident_id:
-        return incident_id == 1
+        return jsonify({'error': 'Missing incident ID in session'}), 400
 
     try:
         incident = db.session.get(Incident, incident_id)
@@ -730,44 +2208,28 @@ def save_completion():
         incident.status = "Completed"
         incident.improvements = improvements
         incident.observations = observations
-        incident.start_datetime = start_time
         incident.end_datetime = end_time
+        db.session.flush()
 
-        def update_incident_progress(incident_step_id, improvements, observations):
-            incident_step = IncidentStep.query.get(incident_step_id)
-            if not incident_step:
-                return 0.0
-
-            if improvements and observations:
-                incident_step.percent_complete = 100.0
-            elif improvements or observations:
-                incident_step.percent_complete = 75.0
-
-            return IncidentStep.progress_percentage(incident_step)
-
-        percent = update_incident_progress(incident_id, improvements, observations)
-        incident.percent_complete = percent
+        percent = recompute_incident_progress(incident_id)
 
         db.session.commit()
-        print(f"[✔️] Incident #{incident_id} atualizado com sucesso com {percent}%.")
+        progress_log.info("Incident #%s concluído com %s%%", incident_id, percent,
+                          extra={'incident_id': incident_id, 'percent': percent})
 
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Database error: ' + str(e)}), 500
 
-    # Guardar info para o relatório
     session['incident_submitted'] = True
-    session['report_data'] = {
-        'class': session.get('class', 'N/A'),
-        'type': session.get('type', 'N/A'),
-        'steps': session.get('steps', []),
-        'sub_steps': session.get('sub_steps', {}),
-        'evidence': session.get('evidence', {}),
-        'attachments': session.get('report_data', {}).get('attachments', {})
-    }
-
     session.modified = True
-    return jsonify({'status': 'success'}), 200
+
+    # O relatório é gerado em segundo plano; o cliente acompanha o job
+    try:
+        job = enqueue_report(incident_id, data.get('engine'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'status': 'success', 'report': report_job_json(job)}), 200
 
 
 @app.route('/incident/complete')
@@ -777,13 +2239,321 @@ def complete(incident_id=None):
     if not username:
         return redirect(url_for('index'))
 
-    if not incident_id:
-        incident_id = session.get('id', '1')
+    if not incident_id:
+        incident_id = session.get('incident_id') or session.get('id', 1)
+
+    incident = db.get_or_404(Incident, incident_id)
+    session['incident_id'] = incident.id
+    return render_template('complete.html', incident=incident, incident_id=incident.id)
+
+
+def step_upload_path(incident_id, step_index, filename):
+    upload_dir = os.path.join(app.root_path, 'uploads', str(incident_id), f"step_{step_index}")
+    os.makedirs(upload_dir, exist_ok=True)
+    return os.path.join(upload_dir, filename)
+
+
+def attach_step_file(incident_id, step_index, filename, source_path, sha256, size, upload=None):
+    """Guarda source_path no blob store, liga-o ao passo e regista o anexo; devolve o caminho relativo.
+
+    Com upload, a UploadSession é apagada na mesma transação que regista o anexo.
+    """
+    blob_store.acquire(db.session.connection(), sha256, size)
+    db.session.commit()
+    try:
+        blob_store.place(source_path, sha256)
+        file_path = step_upload_path(incident_id, step_index, filename)
+        blob_store.link(sha256, file_path)
+
+        relative_path = f"uploads/{incident_id}/step_{step_index}/{filename}"
+        step = IncidentStep.query.filter_by(incident_id=incident_id, step_index=step_index).first()
+        if not step:
+            step = IncidentStep(incident_id=incident_id, step_index=step_index)
+            db.session.add(step)
+            db.session.flush()
+
+        # Um passo pode ter vários anexos; o mesmo nome de ficheiro substitui o anterior
+        attachment = db.session.execute(
+            select(Attachment).where(Attachment.incident_id == incident_id, Attachment.step_index == step_index,
+                                     Attachment.path == relative_path)
+        ).scalar()
+        if attachment is None:
+            attachment = Attachment(incident_id=incident_id, step_id=step.id, step_index=step_index,
+                                    filename=filename, path=relative_path)
+            db.session.add(attachment)
+        previous_sha256 = attachment.sha256
+        attachment.sha256 = sha256
+        attachment.uploaded_at = datetime.utcnow()
+        for key, value in attachment_metadata(file_path).items():
+            setattr(attachment, key, value)
+
+        step.upload_status = True
+        sync_step_completion(step)
+        if upload is not None:
+            db.session.delete(upload)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        blob_store.release([sha256])
+        raise
+
+    # O conteúdo substituído deixa de contar para o seu blob
+    blob_store.release([previous_sha256])
+
+    try:
+        generate_derivatives(file_path)
+    except Exception as e:
+        upload_log.warning("Versões reduzidas de %s não geradas: %s", filename, e)
+    return relative_path
+
+
+UPLOAD_PARTIAL_DIR = os.path.join(app.root_path, 'upload_parts')
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+
+
+# SHA-256 incremental por upload em blocos: {id: (offset, hasher)}. Só serve se todos os
+# blocos passarem por este processo; senão o ficheiro montado é lido uma vez no fim.
+_upload_hashers = {}
+_upload_hashers_lock = threading.Lock()
+
+
+def upload_hasher(upload_id, offset):
+    with _upload_hashers_lock:
+        if offset == 0:
+            _upload_hashers[upload_id] = (0, hashlib.sha256())
+        entry = _upload_hashers.get(upload_id)
+    if entry is None or entry[0] != offset:
+        return None
+    return entry[1]
+
+
+def advance_upload_hash(upload_id, offset, hasher):
+    with _upload_hashers_lock:
+        _upload_hashers[upload_id] = (offset, hasher)
+
+
+def upload_hash(upload_id, size):
+    with _upload_hashers_lock:
+        entry = _upload_hashers.pop(upload_id, None)
+    if entry is None or entry[0] != size:
+        return None
+    return entry[1].hexdigest()
+
+
+def forget_upload_hash(upload_id):
+    with _upload_hashers_lock:
+        _upload_hashers.pop(upload_id, None)
+
+
+def partial_upload_path(upload_id):
+    return os.path.join(UPLOAD_PARTIAL_DIR, f'{upload_id}.part')
+
+
+def discard_partial_upload(upload_id):
+    forget_upload_hash(upload_id)
+    try:
+        os.remove(partial_upload_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+
+def purge_stale_uploads():
+    """Apaga os uploads em blocos abandonados há mais de UPLOAD_SESSION_TTL."""
+    cutoff = datetime.utcnow() - UPLOAD_SESSION_TTL
+    stale = db.session.execute(
+        select(UploadSession.id).where(UploadSession.updated_at < cutoff)
+    ).scalars().all()
+    if not stale:
+        return
+    db.session.execute(delete(UploadSession).where(UploadSession.id.in_(stale)))
+    db.session.commit()
+    for upload_id in stale:
+        discard_partial_upload(upload_id)
+    upload_log.info("%d uploads em blocos expirados removidos", len(stale))
+
+
+def upload_session_json(upload):
+    return {
+        'id': upload.id,
+        'step': upload.step_index,
+        'filename': upload.filename,
+        'size': upload.size,
+        'offset': upload.received,
+        'chunk_size': UPLOAD_CHUNK_BYTES,
+        'url': url_for('upload_chunk', upload_id=upload.id),
+    }
+
+
+def copy_stream(stream, target, length, hasher=None):
+    """Copia até length bytes de stream para target em blocos; devolve os bytes escritos (menos se a ligação cair)."""
+    written = 0
+    try:
+        while written < length:
+            block = stream.read(min(UPLOAD_READ_BLOCK, length - written))
+            if not block:
+                break
+            target.write(block)
+            if hasher is not None:
+                hasher.update(block)
+            written += len(block)
+    except ClientDisconnected:
+        pass
+    return written
+
+
+@app.route('/incident/uploads', methods=['POST'])
+def create_upload():
+    """Abre um upload em blocos: JSON {step, filename, size}."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    incident_id = session.get('incident_id')
+    if not incident_id:
+        return jsonify({'error': 'No incident in session'}), 400
+
+    step_index = data.get('step')
+    filename = secure_filename(str(data.get('filename') or ''))
+    size = data.get('size')
+    if not isinstance(step_index, int) and not str(step_index).isdigit():
+        return jsonify({'error': 'Invalid step index'}), 400
+    if not filename:
+        return jsonify({'error': 'No selected file'}), 400
+    if not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'Invalid file size'}), 400
+    if size > UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'File exceeds the {UPLOAD_MAX_BYTES // (1024 * 1024)} MB limit'}), 413
+
+    purge_stale_uploads()
+    # Retomar: o mesmo ficheiro para o mesmo passo continua a sessão já aberta
+    upload = db.session.execute(
+        select(UploadSession).where(
+            UploadSession.incident_id == incident_id,
+            UploadSession.step_index == int(step_index),
+            UploadSession.filename == filename,
+            UploadSession.size == size,
+        ).order_by(UploadSession.updated_at.desc()).limit(1)
+    ).scalar()
+    created = upload is None or not os.path.exists(partial_upload_path(upload.id))
+    if created:
+        upload = UploadSession(incident_id=incident_id, step_index=int(step_index), filename=filename, size=size)
+        db.session.add(upload)
+        db.session.flush()
+        os.makedirs(UPLOAD_PARTIAL_DIR, exist_ok=True)
+        open(partial_upload_path(upload.id), 'wb').close()
+        db.session.commit()
+        upload_log.info("Upload %s aberto: %s (%d bytes) no passo %s do incidente %s",
+                        upload.id, filename, size, step_index, incident_id)
+
+    if upload.received == upload.size:
+        return complete_upload(upload)
+    return jsonify(upload_session_json(upload)), 201 if created else 200
+
+
+@app.route('/incident/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def upload_chunk(upload_id):
+    """GET devolve o offset para retomar; PUT recebe um bloco com Content-Range; DELETE cancela."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    # Só o incidente da sessão vê os seus uploads, tal como nas rotas dos passos
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.incident_id != session.get('incident_id'):
+        return jsonify({'error': 'Upload not found'}), 404
+
+    if request.method == 'GET':
+        return jsonify(upload_session_json(upload))
+
+    if request.method == 'DELETE':
+        db.session.delete(upload)
+        db.session.commit()
+        discard_partial_upload(upload_id)
+        return jsonify({'status': 'success'})
+
+    match = CONTENT_RANGE_RE.match(request.headers.get('Content-Range', ''))
+    if not match:
+        return jsonify({'error': 'Content-Range header required'}), 400
+    start, end, total = (int(value) for value in match.groups())
+    length = end - start + 1
+    if total != upload.size or end >= total or length <= 0 or length > UPLOAD_CHUNK_BYTES:
+        return jsonify({'error': 'Invalid Content-Range', **upload_session_json(upload)}), 416
+    if request.content_length is not None and request.content_length != length:
+        return jsonify({'error': 'Content-Length does not match Content-Range'}), 400
+    if start != upload.received:
+        # Bloco repetido ou fora de ordem: o cliente retoma a partir do offset devolvido
+        return jsonify({'error': 'Unexpected offset', **upload_session_json(upload)}), 409
+
+    # O bloco é recebido num ficheiro temporário. Só o pedido que ganha o UPDATE condicional
+    # o copia para o ficheiro montado e o junta ao hash, com a linha do upload bloqueada
+    # até ao commit: um bloco perdedor nunca toca no que outro pedido já escreveu.
+    os.makedirs(UPLOAD_PARTIAL_DIR, exist_ok=True)
+    with tempfile.TemporaryFile(dir=UPLOAD_PARTIAL_DIR) as chunk:
+        written = copy_stream(request.stream, chunk, length)
+        result = db.session.execute(
+            update(UploadSession)
+            .where(UploadSession.id == upload_id, UploadSession.received == start)
+            .values(received=start + written, updated_at=datetime.utcnow())
+        )
+        if result.rowcount != 1:
+            db.session.rollback()
+            db.session.refresh(upload)
+            return jsonify({'error': 'Concurrent upload', **upload_session_json(upload)}), 409
+
+        hasher = upload_hasher(upload_id, start)
+        try:
+            chunk.seek(0)
+            with open(partial_upload_path(upload_id), 'r+b') as target:
+                target.seek(start)
+                copy_stream(chunk, target, written, hasher)
+                target.truncate()
+        except OSError as e:
+            db.session.rollback()
+            forget_upload_hash(upload_id)  # o hash incremental deixou de ser fiável
+            upload_log.exception("Falha a escrever o bloco %d-%d do upload %s", start, end, upload_id)
+            return jsonify({'error': str(e)}), 500
+        db.session.commit()
+
+    db.session.refresh(upload)
+    if hasher is not None:
+        advance_upload_hash(upload_id, start + written, hasher)
+    if written < length:
+        return jsonify({'error': 'Incomplete chunk', **upload_session_json(upload)}), 400
+
+    if upload.received == upload.size:
+        return complete_upload(upload)
+    return jsonify(upload_session_json(upload))
+
 
-    incident = IncidentStep.query.get_or_404(incident_id)
-    session['incident_id'] = incident.id
-    session.modified = True
-    return render_template('complete.html', incident=incident, incident_id=incident.id)
+def complete_upload(upload):
+    """Move o ficheiro montado para uploads/<incidente>/step_<n>/ e anexa-o ao passo.
+
+    A sessão e o ficheiro montado só desaparecem depois de o anexo ficar registado: se
+    algo falhar, o cliente volta a pedir a conclusão sem reenviar o ficheiro.
+    """
+    upload_id, size = upload.id, upload.size
+    part_path = partial_upload_path(upload_id)
+    # O blob store consome o ficheiro que recebe; recebe uma ligação e o .part fica
+    source_path = f'{part_path}.{uuid.uuid4().hex}.tmp'
+    try:
+        sha256 = upload_hash(upload_id, size) or file_digest(part_path)
+        try:
+            os.link(part_path, source_path)
+        except OSError:
+            shutil.copyfile(part_path, source_path)
+        relative_path = attach_step_file(upload.incident_id, upload.step_index, upload.filename,
+                                         source_path, sha256, size, upload=upload)
+    except Exception as e:
+        db.session.rollback()
+        try:
+            os.remove(source_path)
+        except OSError:
+            pass
+        upload_log.exception("Falha a concluir o upload %s", upload_id)
+        return jsonify({'status': 'error', 'error': str(e)}), 500
+
+    discard_partial_upload(upload_id)
+    upload_log.info("Upload concluído: %s", relative_path)
+    return jsonify({'status': 'success', 'file': relative_path, 'offset': size, 'size': size})
 
 
 @app.route('/incident/upload_file', methods=['POST'])
@@ -810,60 +2580,57 @@ def upload_file():
         return jsonify({'status': 'error', 'message': 'No incident in session'})
 
     try:
-        upload_dir = os.path.join(app.root_path, 'uploads', str(incident_id), f"step_{step_index}")
-        os.makedirs(upload_dir, exist_ok=True)
-
-        file_path = os.path.join(upload_dir, filename)
-        file.save(file_path)
-
-        relative_path = f"uploads/{incident_id}/step_{step_index}/{filename}"
-
-        step = IncidentStep.query.filter_by(incident_id=incident_id, step_index=step_index).first()
-        if not step:
-            step = IncidentStep(incident_id=incident_id, step_index=step_index)
-            db.session.add(step)
-
-        step.attachment_name = relative_path
-        step.upload_status = True
-        db.session.commit()
+        sha256, size, tmp_path = blob_store.receive(file.stream)
+        relative_path = attach_step_file(incident_id, step_index, filename, tmp_path, sha256, size)
 
         return jsonify({'status': 'success', 'file': relative_path})
 
     except Exception as e:
         db.session.rollback()
-        print("Upload error:", e)
+        upload_log.exception("Falha no upload do passo %s do incidente %s", step_index, incident_id)
         return jsonify({'status': 'error', 'message': str(e)})
 
 
 
+@app.route('/uploads/<path:filename>')
+def uploaded_file(filename):
+    """Anexos; ?size=thumb|report devolve a versão reduzida das imagens."""
+    if 'username' not in session:
+        return redirect(url_for('index'))
+
+    upload_root = os.path.join(app.root_path, 'uploads')
+    size = request.args.get('size')
+    if size in IMAGE_DERIVATIVES:
+        path = safe_join(upload_root, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        return send_file(image_derivative(path, size), max_age=3600)
+    return send_from_directory(upload_root, filename)
+
+
 @app.route('/incident/finish', methods=['POST'])
 def finish_incident():
     username = session.get('username')
     if not username:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    incident_id = session.get('id')
+    incident_id = session.get('incident_id') or session.get('id')
     if not incident_id:
         return jsonify({'error': 'Incident ID missing'}), 400
 
-    incident = db.session.get(IncidentStep, incident_id)
+    incident = db.session.get(Incident, incident_id)
 
-    if not incident or incident.user != username:
+    if not incident:
         return jsonify({'error': 'Not found or not authorized'}), 404
 
-    # Guardar evidências e sub_steps da sessão no modelo
-    incident.evidence = json.dumps(session.get('evidence', {}))
-    incident.sub_steps = json.dumps(session.get('sub_steps', {}))
+    # Evidências e sub_steps já estão gravados em cada IncidentStep
     incident.status = "Completed"
-    incident.end_datetime = datetime.now()
+    incident.end_datetime = datetime.utcnow()
 
     db.session.commit()
 
     # Limpar sessão
     session.pop('id', None)
-    session.pop('evidence', None)
-    session.pop('sub_steps', None)
-    session.pop('steps', None)
     session.pop('class', None)
     session.pop('type', None)
     session.pop('start', None)
@@ -877,96 +2644,20 @@ def download_report():
     if not username:
         return redirect(url_for('index'))
 
-    data = session.get('report_data')
-    if not data:
-        return redirect(url_for('dashboard'))
-
-    lessons = session.get('lessons', {})
-    start_dt = session.get('start')
-    end_dt = session.get('end')
-
-    def parse_dt(dt):
-        if isinstance(dt, str):
-            try:
-                return datetime.fromisoformat(dt)
-            except Exception:
-                return datetime.now()
-        return dt if isinstance(dt, datetime) else datetime.now()
-
-    start_dt = parse_dt(start_dt)
-    end_dt = parse_dt(end_dt)
-
-    steps_raw = data.get('steps', [])
-    sub_steps = data.get('sub_steps', {})
-    evidence = data.get('evidence', {})
-
     incident_id = session.get('incident_id')
-    if not incident_id:
-        incident_id = 1
-
-
-    print('INCIDENT ID:', incident_id)
-
-    # Carregar anexos
-    upload_base = os.path.join('uploads', str(incident_id))
-    attachments = {}
-
-    if os.path.exists(upload_base):
-        for step_folder in os.listdir(upload_base):
-            step_path = os.path.join(upload_base, step_folder)
-            if os.path.isdir(step_path):
-                files = os.listdir(step_path)
-                if files:
-                    attachments[step_folder] = [
-                        os.path.join('uploads', str(incident_id), step_folder, f) for f in files
-                    ]
-
-    # Estruturar os passos com subpassos, evidências e anexos
-    steps_structured = []
-    for index, step in enumerate(steps_raw):
-        step_index = str(index + 1)
-        steps_structured.append({
-            'step': step.get('step', f'Step {step_index}'),
-            'substeps': sub_steps.get(step_index, []),
-            'evidence': evidence.get(step_index, []),
-            'attachments': attachments.get(step_index, []),
-        })
-
-    dados_template = {
-        'current_date': datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
-        'incident_id': incident_id,
-        'selected_class': data.get('class', 'N/A'),
-        'selected_type': data.get('type', 'N/A'),
-        'start_time': start_dt.strftime('%d/%m/%Y %H:%M:%S'),
-        'end_time': end_dt.strftime('%d/%m/%Y %H:%M:%S'),
-        'steps': steps_structured,
-        'improvements': lessons.get('improvements', ''),
-        'observations': lessons.get('observations', '')
-    }
-
-    basedir = os.path.abspath(os.path.dirname(__file__))
-    template_path = os.path.join(basedir, 'word_templates', 'incidentreport_template.docx')
-
-    try:
-        pdf_path_temp = gerar_docx_com_dados(dados_template, template_path=template_path)
-
-        # Guardar permanentemente
-        permanent_dir = os.path.join(app.root_path, 'relatorios')
-        os.makedirs(permanent_dir, exist_ok=True)
-
-        final_pdf_path = os.path.join(permanent_dir, f'incident_{incident_id}.pdf')
-        shutil.copy(pdf_path_temp, final_pdf_path)
-
-    except Exception as e:
-        print("Erro ao gerar PDF:", e)
+    if not incident_id or not db.session.get(Incident, incident_id):
         return redirect(url_for('dashboard'))
 
-    filename = f"report_{datetime.now().strftime('%d-%m-%Y')}_{dados_template['selected_type'].replace(' ', '_')}.pdf"
-
-    session.modified = True
-
-    return send_file(final_pdf_path, as_attachment=True, download_name=filename)
+    # A geração corre na fila de relatórios; o pedido já não espera pelo LibreOffice
+    try:
+        job = enqueue_report(incident_id, request.args.get('engine'))
+    except ValueError:
+        abort(400)
+    if job.status == 'done':
+        return send_file(report_file(job), as_attachment=True, download_name=report_download_name(job))
 
+    flash("The report is being generated. Use the download button on the dashboard when it is ready.", "info")
+    return redirect(url_for('dashboard'))
 
 
 def flatten_data(data):
@@ -984,9 +2675,14 @@ def flatten_data(data):
 
 @app.route('/incident/<int:incident_id>/download', methods=['GET', 'HEAD'])
 def download_incident(incident_id):
-    filepath = os.path.join(app.root_path, 'reports', f'incident_{incident_id}.pdf')
+    """Serve o relatório em cache para os dados atuais do incidente; 404 se ainda não foi gerado."""
+    try:
+        dados, cache_key = report_inputs(incident_id, report_engine(request.args.get('engine')))
+    except (LookupError, ValueError):
+        return '', 404 if request.method == 'HEAD' else abort(404)
 
-    if not os.path.exists(filepath):
+    filepath = report_store.get(cache_key)
+    if filepath is None:
         return '', 404 if request.method == 'HEAD' else abort(404)
 
     if request.method == 'HEAD':
@@ -995,21 +2691,124 @@ def download_incident(incident_id):
     return send_file(filepath, as_attachment=True, download_name=f'incident_{incident_id}.pdf')
 
 
-def gerar_docx_com_dados(dados, template_path='word_templates/incidentreport_template.docx'):
-    # Criação de diretório temporário para guardar o ficheiro Word final
-    temp_dir = tempfile.mkdtemp()
+REPORT_TEMPLATE_PATH = os.path.join(basedir, 'word_templates', 'incidentreport_template.docx')
+REPORT_DIR = 'reports'
+# Subir quando a renderização mudar de forma que o template não reflita (invalida a cache)
+REPORT_FORMAT_VERSION = 1
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_MB', '512')) * 1024 * 1024
+# docx: template Word + LibreOffice; fpdf: PDF gerado diretamente, sem binários externos
+REPORT_ENGINES = ('docx', 'fpdf')
+REPORT_ENGINE = os.environ.get('REPORT_ENGINE', 'docx')
+REPORT_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+# Versões reduzidas das imagens anexadas, guardadas em _derived/ ao lado do original
+IMAGE_DERIVATIVES = {
+    'report': {'max_size': 1200, 'quality': 85},
+    'thumb': {'max_size': 320, 'quality': 75},
+}
+DERIVATIVES_DIR = '_derived'
+
+
+def derivative_path(path, kind):
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, DERIVATIVES_DIR, f'{filename}.{kind}.jpg')
+
+
+def generate_derivatives(path):
+    """Gera as versões reduzidas (JPEG) de uma imagem; devolve {tipo: caminho}."""
+    modules = pillow()
+    if modules is None or not path.lower().endswith(REPORT_IMAGE_EXTENSIONS):
+        return {}
+    Image, ImageOps = modules
+
+    derivatives = {}
+    with Image.open(path) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG não tem transparência: assentar sobre branco, como fica no relatório
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        for kind, options in IMAGE_DERIVATIVES.items():
+            target = derivative_path(path, kind)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            resized = image.copy()
+            resized.thumbnail((options['max_size'], options['max_size']), Image.LANCZOS)
+            partial_path = f'{target}.{uuid.uuid4().hex}.tmp'
+            resized.save(partial_path, 'JPEG', quality=options['quality'], optimize=True, progressive=True)
+            os.replace(partial_path, target)
+            derivatives[kind] = target
+    return derivatives
+
+
+def image_derivative(path, kind):
+    """Versão reduzida da imagem, gerada se faltar ou estiver desatualizada; senão o original."""
+    target = derivative_path(path, kind)
+    try:
+        if os.stat(target).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return target
+    except OSError:
+        pass
+    try:
+        return generate_derivatives(path).get(kind, path)
+    except Exception as e:
+        log.warning("Não foi possível reduzir %s: %s", os.path.basename(path), e)
+        return path
+
+
+class TemplateCache:
+    """Bytes dos templates DOCX lidos uma vez por processo.
+
+    Cada render abre o seu DocxTemplate a partir de um BytesIO, sem ler o disco nem
+    copiar árvores XML; os bytes só são relidos quando o ficheiro muda.
+    """
+
+    def __init__(self):
+        self._contents = {}
+        self._lock = threading.Lock()
+
+    def get(self, template_path):
+        from docxtpl import DocxTemplate
+
+        stat = os.stat(template_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._contents.get(template_path)
+            if cached is None or cached[0] != version:
+                report_log.debug("A carregar o template %s", template_path)
+                with open(template_path, 'rb') as fh:
+                    cached = (version, fh.read())
+                self._contents[template_path] = cached
+
+        return DocxTemplate(io.BytesIO(cached[1]))
+
+
+template_cache = TemplateCache()
+
+
+def gerar_docx_com_dados(dados, template_path=REPORT_TEMPLATE_PATH, output_dir=None):
+    from docx.shared import Inches
+    from docxtpl import InlineImage
+
+    # Diretório de trabalho para o ficheiro Word final (temporário se não for indicado)
+    temp_dir = output_dir or tempfile.mkdtemp()
     output_docx = os.path.join(temp_dir, 'incidentreport.docx')
 
-    # Carregar template do Word
-    doc = DocxTemplate(template_path)
+    # Cópia do template já analisado
+    doc = template_cache.get(template_path)
 
     # Processar imagens para cada passo
     for step in dados.get('steps', []):
         imagens = []
         for path in step.get('attachments', []):
             full_path = os.path.join(os.getcwd(), path)
-            if os.path.exists(full_path):
-                imagens.append(InlineImage(doc, full_path, width=Inches(3)))
+            # Só imagens podem ser embebidas no documento
+            if os.path.exists(full_path) and full_path.lower().endswith(REPORT_IMAGE_EXTENSIONS):
+                imagens.append(InlineImage(doc, image_derivative(full_path, 'report'), width=Inches(3)))
         step['attachments'] = imagens
 
     # Preencher e guardar documento
@@ -1022,96 +2821,935 @@ def gerar_docx_com_dados(dados, template_path='word_templates/incidentreport_tem
     return output_pdf
 
 
-
-
-def converter_para_pdf_com_libreoffice(docx_path):
-    output_dir = os.path.dirname(docx_path)
-
+def find_soffice():
     os_name = platform.system()
     if os_name == "Windows":
         libreoffice_path = r"C:\Program Files\LibreOffice\program\soffice.exe"
     elif os_name == "Darwin":
         libreoffice_path = "/Applications/LibreOffice.app/Contents/MacOS/soffice"
     elif os_name == "Linux":
-        libreoffice_path = "libreoffice"
+        libreoffice_path = shutil.which("soffice") or shutil.which("libreoffice") or "libreoffice"
     else:
         raise EnvironmentError(f"Sistema operacional '{os_name}' não suportado.")
 
     if not os.path.exists(libreoffice_path):
         raise FileNotFoundError("LibreOffice não foi encontrado no caminho especificado.")
+    return libreoffice_path
 
-    try:
-        subprocess.run([
-            libreoffice_path, "--headless", "--convert-to", "pdf", "--outdir", output_dir, docx_path
-        ], check=True)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Erro ao converter DOCX para PDF com LibreOffice: {e}")
 
+def profile_arg(profile_dir):
+    # Perfil próprio por instância: processos concorrentes não disputam o mesmo perfil
+    return '-env:UserInstallation=' + pathlib.Path(profile_dir).as_uri()
+
+
+SOFFICE_POOL_SIZE = int(os.environ.get('SOFFICE_POOL_SIZE', '1'))  # 0 desliga o pool
+SOFFICE_START_TIMEOUT = float(os.environ.get('SOFFICE_START_TIMEOUT', '30'))
+SOFFICE_ACQUIRE_TIMEOUT = float(os.environ.get('SOFFICE_ACQUIRE_TIMEOUT', '120'))
+SOFFICE_MAX_CONVERSIONS = int(os.environ.get('SOFFICE_MAX_CONVERSIONS', '200'))
+
+
+class SofficeInstance:
+    """Um soffice headless de longa duração, ligado por UNO através de um pipe com nome."""
+
+    def __init__(self, uno, property_value, name):
+        self.uno = uno
+        self.property_value = property_value
+        self.pipe = f'irp_soffice_{os.getpid()}_{name}'
+        self.process = None
+        self.profile_dir = None
+        self.desktop = None
+        self.conversions = 0
+
+    def start(self):
+        self.profile_dir = tempfile.mkdtemp(prefix='irp-soffice-')
+        self.process = subprocess.Popen([
+            find_soffice(), '--headless', '--invisible', '--nologo', '--norestore', '--nodefault',
+            '--nolockcheck', profile_arg(self.profile_dir),
+            f'--accept=pipe,name={self.pipe};urp;StarOffice.ComponentContext'
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        local = self.uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext('com.sun.star.bridge.UnoUrlResolver', local)
+        deadline = time.monotonic() + SOFFICE_START_TIMEOUT
+        while True:
+            try:
+                ctx = resolver.resolve(f'uno:pipe,name={self.pipe};urp;StarOffice.ComponentContext')
+                break
+            except Exception:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("LibreOffice não arrancou a tempo")
+                time.sleep(0.2)
+        self.desktop = ctx.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', ctx)
+        self.conversions = 0
+        report_log.info("soffice %s pronto (pid %s)", self.pipe, self.process.pid)
+
+    def healthy(self):
+        if self.process is None or self.process.poll() is not None or self.desktop is None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def props(self, **values):
+        return tuple(self.property_value(Name=key, Value=value) for key, value in values.items())
+
+    def convert(self, docx_path, pdf_path):
+        document = self.desktop.loadComponentFromURL(
+            pathlib.Path(docx_path).as_uri(), '_blank', 0, self.props(Hidden=True, ReadOnly=True)
+        )
+        try:
+            document.storeToURL(pathlib.Path(pdf_path).as_uri(), self.props(FilterName='writer_pdf_Export'))
+        finally:
+            document.close(True)
+        self.conversions += 1
+
+    def stop(self):
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            self.desktop = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self.profile_dir:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+
+
+class SofficePool:
+    """Instâncias soffice quentes, arrancadas a pedido e partilhadas pelas conversões do processo.
+
+    A fila de instâncias livres limita a concorrência ao tamanho do pool; cada instância
+    é verificada antes de ser usada e reiniciada se morreu, falhou uma conversão ou
+    atingiu SOFFICE_MAX_CONVERSIONS.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = None
+        self._instances = []
+        self._lock = threading.Lock()
+        self._available = None
+
+    def available(self):
+        if self._available is None:
+            try:
+                import uno
+                from com.sun.star.beans import PropertyValue
+                self._uno = (uno, PropertyValue)
+                self._available = self.size > 0
+            except ImportError:
+                report_log.info("Módulo uno indisponível: conversões com um soffice novo por PDF")
+                self._available = False
+        return self._available
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._idle is not None:
+                return
+            self._idle = queue.Queue()
+            for n in range(self.size):
+                instance = SofficeInstance(*self._uno, name=n)
+                self._instances.append(instance)
+                self._idle.put(instance)
+            # Corre no fim do processo, incluindo os workers do ProcessPoolExecutor
+            multiprocessing.util.Finalize(self, self.stop, exitpriority=10)
+
+    def convert(self, docx_path, pdf_path):
+        self._ensure_started()
+        try:
+            instance = self._idle.get(timeout=SOFFICE_ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError("Nenhuma instância LibreOffice livre")
+        try:
+            if not instance.healthy() or instance.conversions >= SOFFICE_MAX_CONVERSIONS:
+                instance.stop()
+                instance.start()
+            try:
+                instance.convert(docx_path, pdf_path)
+            except Exception:
+                # Estado desconhecido depois de uma falha: recomeçar do zero na próxima vez
+                report_log.warning("Conversão falhou em %s; a instância vai ser reiniciada", instance.pipe)
+                instance.stop()
+                raise
+        finally:
+            self._idle.put(instance)
+
+    def stop(self):
+        for instance in self._instances:
+            instance.stop()
+
+
+soffice_pool = SofficePool(SOFFICE_POOL_SIZE)
+
+
+def converter_para_pdf_com_libreoffice(docx_path):
     pdf_path = os.path.splitext(docx_path)[0] + ".pdf"
+
+    if soffice_pool.available():
+        soffice_pool.convert(docx_path, pdf_path)
+        return pdf_path
+
+    # Sem UNO: um soffice por conversão, com perfil próprio
+    output_dir = os.path.dirname(docx_path)
+    with tempfile.TemporaryDirectory(prefix='irp-soffice-') as profile_dir:
+        try:
+            subprocess.run([
+                find_soffice(), profile_arg(profile_dir), "--headless", "--convert-to", "pdf",
+                "--outdir", output_dir, docx_path
+            ], check=True)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f"Erro ao converter DOCX para PDF com LibreOffice: {e}")
+
     return pdf_path
 
 
+def build_report_data(incident_id):
+    """Dados do template do relatório, lidos do Incident e das linhas dos passos."""
+    incident = db.session.get(Incident, incident_id)
+    if incident is None:
+        raise LookupError(f'Incident {incident_id} not found')
+
+    try:
+        playbook_steps = json.loads(incident.steps or '[]')
+    except ValueError:
+        playbook_steps = []
+    rows = {row.step_index: row for row in IncidentStep.query.filter_by(incident_id=incident_id)}
+    files = step_attachments(incident_id)
+
+    steps_structured = []
+    for index, step in enumerate(playbook_steps, start=1):
+        row = rows.get(index)
+        try:
+            checked = json.loads(row.sub_steps or '[]') if row else []
+        except ValueError:
+            checked = []
+        steps_structured.append({
+            'step': step.get('step', f'Step {index}'),
+            'substeps': checked,
+            'evidence': (row.evidence or '') if row else '',
+            'attachments': [os.path.join(basedir, attachment.path) for attachment in files.get(index, [])],
+            'attachment_digests': [attachment.sha256 for attachment in files.get(index, [])],
+        })
+
+    def fmt(dt):
+        # Sem data: texto fixo, para que a chave da cache não mude a cada pedido
+        return dt.strftime('%d/%m/%Y %H:%M:%S') if dt else '—'
+
+    return {
+        'current_date': datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+        'incident_id': incident.id,
+        'selected_class': incident.incident_class or 'N/A',
+        'selected_type': incident.incident_type or 'N/A',
+        'start_time': fmt(incident.start_datetime),
+        'end_time': fmt(incident.end_datetime),
+        'steps': steps_structured,
+        'improvements': incident.improvements or '',
+        'observations': incident.observations or ''
+    }
+
+
+_digest_cache = {}
+_digest_lock = threading.Lock()
+
+
+def file_digest(path):
+    """SHA-256 do ficheiro, memorizado por (caminho, tamanho, mtime)."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    with _digest_lock:
+        digest = _digest_cache.get(memo_key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with _digest_lock:
+            _digest_cache[memo_key] = digest
+    return digest
+
+
+def report_engine(value=None):
+    """Motor pedido (ou o configurado por omissão); ValueError se for desconhecido."""
+    engine = (value or REPORT_ENGINE).strip().lower()
+    if engine not in REPORT_ENGINES:
+        raise ValueError(f'Unknown report engine: {engine}')
+    return engine
+
+
+def report_cache_key(dados, engine):
+    """Hash de tudo o que entra no PDF: dados do incidente, anexos, motor e versão do template."""
+    payload = {key: value for key, value in dados.items() if key != 'current_date'}
+    # Caminhos relativos à raiz da aplicação: a chave não muda se a instalação mudar de sítio
+    payload['steps'] = [
+        {**step, 'attachments': [os.path.relpath(path, basedir) for path in step.get('attachments', [])]}
+        for step in dados.get('steps', [])
+    ]
+    payload['engine'] = engine
+    # O SHA-256 vem da tabela attachment; só os anexos migrados sem blob obrigam a ler o ficheiro
+    attachments = sorted({
+        (path, digest) for step in dados.get('steps', [])
+        for path, digest in zip(step.get('attachments', []), step.get('attachment_digests', []))
+    }, key=lambda item: item[0])
+    payload['attachment_digests'] = [(os.path.relpath(path, basedir), digest or file_digest(path))
+                                     for path, digest in attachments]
+    payload['template'] = file_digest(REPORT_TEMPLATE_PATH)
+    payload['image_derivatives'] = IMAGE_DERIVATIVES if pillow() else None
+    payload['format'] = REPORT_FORMAT_VERSION
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def report_inputs(incident_id, engine):
+    dados = build_report_data(incident_id)
+    return dados, report_cache_key(dados, engine)
+
+
+class ReportStore:
+    """PDFs gerados, um ficheiro por chave de conteúdo em reports/.
+
+    O mtime serve de marca LRU: cada acerto atualiza-o e, acima do limite de
+    tamanho, os ficheiros menos usados são apagados primeiro.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def relative_path(self, cache_key):
+        return os.path.join(REPORT_DIR, f'{cache_key}.pdf')
+
+    def path(self, cache_key):
+        return os.path.join(self.directory, f'{cache_key}.pdf')
+
+    def get(self, cache_key):
+        path = self.path(cache_key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith('.pdf'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    report_log.info("Relatório removido da cache: %s", os.path.basename(path))
+                except OSError:
+                    pass
+
+    def discard(self, relative_paths):
+        for relative_path in relative_paths:
+            try:
+                os.remove(os.path.join(app.root_path, relative_path))
+            except OSError:
+                pass
+
+
+report_store = ReportStore(os.path.join(app.root_path, REPORT_DIR), REPORT_CACHE_MAX_BYTES)
+
+
+PDF_FONT_DIR = os.path.join(basedir, 'static', 'fonts')
+# O fpdf grava as métricas das fontes (.pkl) na primeira renderização: numa pasta
+# da instância, nunca ao lado dos TTF (o código pode estar só de leitura)
+PDF_FONT_CACHE_DIR = os.environ.get('PDF_FONT_CACHE_DIR', os.path.join(app.instance_path, 'fpdf_cache'))
+# Família -> TTF
+PDF_FONTS = {
+    'Oktah': 'Fontspring-DEMO-oktah_regular-BF651105f8625b4.ttf',
+    'OktahLight': 'oktah_extralight-BF651105f8a1dae.ttf',
+}
+PDF_MISSING_GLYPH = '?'
+
+
+class IncidentReportLayout:
+    """Relatório do incidente desenhado diretamente com FPDF e as fontes Oktah.
+
+    Só é combinado com a classe FPDF em report_pdf_class(), para o fpdf não ser importado no arranque.
+    """
+
+    def __init__(self, dados):
+        super().__init__(format='A4')
+        self.dados = dados
+        for family, filename in PDF_FONTS.items():
+            path = os.path.join(PDF_FONT_DIR, filename)
+            self.add_font(family, '', path, uni=True)
+        self.alias_nb_pages()
+        self.set_auto_page_break(True, margin=18)
+        self.set_margins(18, 18, 18)
+
+    def normalize_text(self, txt):
+        """Troca por PDF_MISSING_GLYPH os caracteres sem glifo na fonte atual.
+
+        O fpdf 1.7 só faz subset do BMP: acima de U+FFFF (emoji) rebenta em _putTTfontwidths.
+        Passa por aqui todo o texto de cell(), multi_cell() e get_string_width().
+        """
+        txt = super().normalize_text(txt)
+        if not self.unifontsubset or not isinstance(txt, str):
+            return txt
+        widths = self.current_font['cw']
+        return ''.join(
+            char if ord(char) < len(widths) and (widths[ord(char)] or not char.isprintable()) else PDF_MISSING_GLYPH
+            for char in txt
+        )
+
+    def header(self):
+        self.set_font('Oktah', '', 9)
+        self.set_text_color(120, 120, 120)
+        self.cell(0, 6, f"Incident #{self.dados['incident_id']} - {self.dados['selected_class']} / "
+                        f"{self.dados['selected_type']}", 0, 1, 'R')
+        self.ln(2)
+
+    def footer(self):
+        self.set_y(-12)
+        self.set_font('OktahLight', '', 8)
+        self.set_text_color(120, 120, 120)
+        self.cell(0, 6, f"Generated {self.dados['current_date']}  -  Page {self.page_no()}/{{nb}}", 0, 0, 'C')
+
+    def heading(self, text, size=13):
+        self.set_font('Oktah', '', size)
+        self.set_text_color(40, 40, 40)
+        self.multi_cell(0, size * 0.55, text)
+        self.ln(1)
+
+    def paragraph(self, text, size=10):
+        self.set_font('OktahLight', '', size)
+        self.set_text_color(0, 0, 0)
+        self.multi_cell(0, 5, text or '—')
+        self.ln(1)
+
+    def attachment(self, path):
+        name = os.path.basename(path)
+        if os.path.exists(path) and path.lower().endswith(REPORT_IMAGE_EXTENSIONS):
+            try:
+                self.image(image_derivative(path, 'report'), w=80)
+                self.ln(2)
+                return
+            except Exception as e:
+                report_log.warning("Imagem %s não incluída no PDF: %s", name, e)
+        self.paragraph(f'Attachment: {name}', size=9)
+
+    def build(self):
+        dados = self.dados
+        self.add_page()
+        self.heading('Incident Response Report', size=20)
+        self.paragraph(f"Class: {dados['selected_class']}\nType: {dados['selected_type']}\n"
+                       f"Start: {dados['start_time']}\nEnd: {dados['end_time']}")
+        self.ln(3)
+
+        for number, step in enumerate(dados.get('steps', []), start=1):
+            self.heading(f"{number}. {step['step']}")
+            for substep in step.get('substeps', []):
+                self.paragraph(f'- {substep}')
+            self.set_font('Oktah', '', 10)
+            self.cell(0, 6, 'Evidence', 0, 1)
+            self.paragraph(step.get('evidence'))
+            for path in step.get('attachments', []):
+                self.attachment(path)
+            self.ln(2)
+
+        self.heading('Lessons learned')
+        self.set_font('Oktah', '', 10)
+        self.cell(0, 6, 'Improvements', 0, 1)
+        self.paragraph(dados.get('improvements'))
+        self.set_font('Oktah', '', 10)
+        self.cell(0, 6, 'Observations', 0, 1)
+        self.paragraph(dados.get('observations'))
+        return self
+
+
+@functools.cache
+def report_pdf_class():
+    from fpdf import FPDF, set_global
+    try:
+        os.makedirs(PDF_FONT_CACHE_DIR, exist_ok=True)
+        set_global('FPDF_CACHE_MODE', 2)  # <cache>/<md5 do caminho do TTF>.pkl
+        set_global('FPDF_CACHE_DIR', PDF_FONT_CACHE_DIR)
+    except OSError as e:
+        report_log.warning("Sem cache de métricas das fontes em %s: %s", PDF_FONT_CACHE_DIR, e)
+        set_global('FPDF_CACHE_MODE', 1)  # sem cache: as métricas são lidas do TTF em cada relatório
+    return type('IncidentReportPDF', (IncidentReportLayout, FPDF), {})
+
+
+def render_report_pdf(dados, output_path, engine='docx'):
+    """Renderiza o relatório para output_path. Corre nos workers: não toca na base de dados."""
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # Escrever ao lado e trocar, para nunca servir um PDF a meio
+    # (nome único: com o executor de threads dois renders da mesma chave podem correr juntos)
+    partial_path = f'{output_path}.{uuid.uuid4().hex}.tmp'
+    try:
+        if engine == 'fpdf':
+            report_pdf_class()(dados).build().output(partial_path, 'F')
+        else:
+            with tempfile.TemporaryDirectory() as work_dir:
+                pdf_path = gerar_docx_com_dados(dados, output_dir=work_dir)
+                shutil.copyfile(pdf_path, partial_path)
+        os.replace(partial_path, output_path)
+    except BaseException:
+        # Um nome único por render: sem esta limpeza os parciais falhados ficavam para sempre
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+        raise
+    return output_path
+
+
+def report_worker_init():
+    # Processo filho (fork): não reutilizar as ligações à base de dados do pai
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '2'))
+REPORT_EXECUTOR = os.environ.get('REPORT_EXECUTOR', 'process')  # process | thread
+REPORT_JOB_TIMEOUT = timedelta(seconds=int(os.environ.get('REPORT_JOB_TIMEOUT', '600')))
+REPORT_MAX_ATTEMPTS = int(os.environ.get('REPORT_MAX_ATTEMPTS', '2'))
+REPORT_POLL_SECONDS = 2.0
+
+
+def report_file(job):
+    return os.path.join(app.root_path, job.output_path)
+
+
+def report_download_name(job):
+    incident = db.session.get(Incident, job.incident_id)
+    incident_type = (incident.incident_type if incident else None) or 'incident'
+    return f"report_{(job.finished_at or datetime.now()).strftime('%d-%m-%Y')}_{incident_type.replace(' ', '_')}.pdf"
+
+
+def claim_report_job():
+    """Reclama o job mais antigo em fila. O UPDATE condicional garante um único dono."""
+    while True:
+        job_id = db.session.execute(
+            select(ReportJob.id).where(ReportJob.status == 'queued').order_by(ReportJob.created_at).limit(1)
+        ).scalar()
+        if job_id is None:
+            return None
+        claimed = db.session.execute(
+            update(ReportJob)
+            .where(ReportJob.id == job_id, ReportJob.status == 'queued')
+            .values(status='running', started_at=datetime.utcnow(), attempts=ReportJob.attempts + 1)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(ReportJob, job_id)
+
+
+def requeue_stale_jobs():
+    """Jobs 'running' há demasiado tempo pertenciam a um worker que morreu."""
+    cutoff = datetime.utcnow() - REPORT_JOB_TIMEOUT
+    stale = (ReportJob.status == 'running', ReportJob.started_at < cutoff)
+    db.session.execute(
+        update(ReportJob).where(*stale, ReportJob.attempts < REPORT_MAX_ATTEMPTS).values(status='queued')
+    )
+    db.session.execute(
+        update(ReportJob).where(*stale).values(
+            status='failed', finished_at=datetime.utcnow(), error='Report worker timed out'
+        )
+    )
+    db.session.commit()
+
+
+def finish_report_job(job_id, error=None):
+    db.session.execute(
+        update(ReportJob).where(ReportJob.id == job_id).values(
+            status='failed' if error else 'done',
+            error=error,
+            finished_at=datetime.utcnow()
+        )
+    )
+    db.session.commit()
+
+
+class ReportQueue:
+    """Executa os jobs da tabela report_job num pool local de processos.
+
+    Uma thread de despacho por processo web reclama jobs e entrega a renderização
+    ao pool; o estado fica sempre na base de dados, por isso vários processos web
+    podem partilhar a mesma fila e um reinício não perde pedidos.
+    """
+
+    def __init__(self, workers, executor_kind):
+        self.workers = max(workers, 1)
+        self.executor_kind = executor_kind
+        self._executor = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = 0
+
+    def _new_executor(self):
+        if self.executor_kind == 'thread':
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='report')
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=report_worker_init)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = self._new_executor()
+            self._thread = threading.Thread(target=self._run, name='report-dispatcher', daemon=True)
+            self._thread.start()
+        report_log.info("Fila de relatórios iniciada: %s workers (%s)", self.workers, self.executor_kind)
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(REPORT_POLL_SECONDS)
+            self._wake.clear()
+            try:
+                with app.app_context():
+                    requeue_stale_jobs()
+                    self._dispatch()
+            except Exception:
+                report_log.exception("Erro no despacho da fila de relatórios")
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self._running >= self.workers:
+                    return
+            job = claim_report_job()
+            if job is None:
+                return
+            try:
+                dados, cache_key = report_inputs(job.incident_id, report_engine(job.engine))
+            except Exception as e:
+                report_log.exception("Erro ao preparar o relatório do job %s", job.id)
+                finish_report_job(job.id, error=str(e))
+                continue
+
+            # Os dados podem ter mudado desde o pedido: o job aponta sempre para a chave atual
+            job.output_path = report_store.relative_path(cache_key)
+            db.session.commit()
+            if report_store.get(cache_key):
+                finish_report_job(job.id)
+                continue
+
+            with self._lock:
+                self._running += 1
+            report_log.debug("Job %s: a gerar relatório do incidente %s", job.id, job.incident_id)
+            try:
+                future = self._executor.submit(render_report_pdf, dados, report_file(job), report_engine(job.engine))
+            except RuntimeError:
+                # Pool a encerrar (fim do processo): o job volta à fila para outro worker
+                with self._lock:
+                    self._running -= 1
+                db.session.execute(update(ReportJob).where(ReportJob.id == job.id).values(status='queued'))
+                db.session.commit()
+                return
+            future.add_done_callback(lambda f, job_id=job.id: self._finished(job_id, f))
+
+    def _finished(self, job_id, future):
+        with self._lock:
+            self._running -= 1
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # Um worker morreu: o pool fica inutilizável e tem de ser recriado
+            with self._lock:
+                self._executor = self._new_executor()
+        if error is not None:
+            report_log.error("Job %s falhou", job_id, exc_info=error)
+        with app.app_context():
+            finish_report_job(job_id, error=f'{type(error).__name__}: {error}' if error is not None else None)
+        if error is None:
+            report_store.evict()
+        self.notify()
+
+
+report_queue = ReportQueue(REPORT_WORKERS, REPORT_EXECUTOR)
+
+
+def enqueue_report(incident_id, engine=None):
+    """Devolve um job para o relatório atual do incidente.
+
+    Se o PDF destes dados já está na cache o job nasce concluído; senão reutiliza
+    um job pendente para a mesma chave ou põe um novo em fila.
+    """
+    engine = report_engine(engine)
+    dados, cache_key = report_inputs(incident_id, engine)
+    output_path = report_store.relative_path(cache_key)
+
+    if report_store.get(cache_key):
+        job = db.session.execute(
+            select(ReportJob)
+            .where(ReportJob.incident_id == incident_id, ReportJob.output_path == output_path,
+                   ReportJob.status == 'done')
+            .order_by(ReportJob.created_at.desc())
+            .limit(1)
+        ).scalar()
+        if job is None:
+            now = datetime.utcnow()
+            job = ReportJob(incident_id=incident_id, engine=engine, output_path=output_path, status='done',
+                            created_at=now, finished_at=now)
+            db.session.add(job)
+            db.session.commit()
+        return job
+
+    job = db.session.execute(
+        select(ReportJob)
+        .where(ReportJob.incident_id == incident_id, ReportJob.output_path == output_path,
+               ReportJob.status.in_(('queued', 'running')))
+        .order_by(ReportJob.created_at.desc())
+        .limit(1)
+    ).scalar()
+    if job is None:
+        job = ReportJob(incident_id=incident_id, engine=engine, output_path=output_path)
+        db.session.add(job)
+        db.session.commit()
+        report_log.info("Relatório do incidente %s em fila (job %s)", incident_id, job.id)
+    report_queue.start()
+    report_queue.notify()
+    return job
+
+
+def report_job_json(job):
+    payload = {
+        'id': job.id,
+        'incident_id': job.incident_id,
+        'status': job.status,
+        'engine': job.engine,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'status_url': url_for('report_job_status', job_id=job.id),
+    }
+    if job.status == 'done':
+        payload['download_url'] = url_for('report_job_download', job_id=job.id)
+    return payload
+
+
+@app.route('/incident/<int:incident_id>/report', methods=['GET', 'POST'])
+def incident_report(incident_id):
+    """POST põe o relatório em fila; GET devolve o estado do último job do incidente."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if not db.session.get(Incident, incident_id):
+        return jsonify({'error': 'Incident not found'}), 404
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            job = enqueue_report(incident_id, data.get('engine') or request.args.get('engine'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(report_job_json(job)), 202
+
+    job = db.session.execute(
+        select(ReportJob).where(ReportJob.incident_id == incident_id)
+        .order_by(ReportJob.created_at.desc()).limit(1)
+    ).scalar()
+    if job is None:
+        return jsonify({'incident_id': incident_id, 'status': 'missing'}), 404
+    payload = report_job_json(job)
+    # False se o incidente mudou desde este job (o PDF já não corresponde aos dados)
+    current_key = report_inputs(incident_id, report_engine(job.engine))[1]
+    payload['current'] = job.output_path == report_store.relative_path(current_key)
+    return jsonify(payload)
+
+
+@app.route('/reports/jobs/<job_id>')
+def report_job_status(job_id):
+    """Estado atual do job. Responde logo: o cliente volta a perguntar com backoff."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    job = db.session.get(ReportJob, job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(report_job_json(job))
+
+
+@app.route('/reports/jobs/<job_id>/download')
+def report_job_download(job_id):
+    if 'username' not in session:
+        return redirect(url_for('index'))
+
+    job = db.get_or_404(ReportJob, job_id)
+    if job.status != 'done' or not os.path.exists(report_file(job)):
+        abort(404)
+    return send_file(report_file(job), as_attachment=True, download_name=report_download_name(job))
+
+
+def int_arg(value, default, minimum=None, maximum=None):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = default
+    if minimum is not None:
+        value = max(value, minimum)
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
 @app.route('/search', methods=['POST'])
 def search():
-    data = request.get_json()
-    query = data.get('query', '').lower()
+    data = request.get_json(silent=True) or {}
+    query = (data.get('query') or '').strip()
+    limit = int_arg(data.get('limit'), 20, 1, 100)
+    offset = int_arg(data.get('offset'), 0, 0)
+
+    if len(query) < 2:
+        return jsonify({'results': [], 'total': 0, 'limit': limit, 'offset': offset})
+
+    total, results = playbook_catalog.snapshot().search_index.search(query, limit=limit, offset=offset)
+
+    return jsonify({'results': results, 'total': total, 'limit': limit, 'offset': offset})
+
+
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+
+def fts_match_query(query):
+    # Cada termo vira um prefixo entre aspas, para que o input do utilizador
+    # nunca seja interpretado como sintaxe FTS5
+    tokens = search_tokens(query)
+    return ' '.join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
+
+
+def tsquery_match_query(query):
+    # search_tokens só devolve caracteres de palavra, seguros para to_tsquery
+    return ' & '.join(f'{token}:*' for token in search_tokens(query))
+
+
+STEP_TEXT_COLUMNS = HISTORY_FTS_SCHEMA['incident_step_fts'][1]
+INCIDENT_TEXT_COLUMNS = HISTORY_FTS_SCHEMA['incident_fts'][1]
+
+HISTORY_SEARCH_SQL = {
+    'sqlite': (fts_match_query, """
+        SELECT 'step' AS source, s.incident_id AS incident_id, s.step_index AS step_index,
+               i.incident_class AS incident_class, i.incident_type AS incident_type,
+               snippet(incident_step_fts, -1, :start, :end, '…', 16) AS snippet,
+               -bm25(incident_step_fts) AS score
+        FROM incident_step_fts
+        JOIN incident_step s ON s.id = incident_step_fts.rowid
+        JOIN incident i ON i.id = s.incident_id
+        WHERE incident_step_fts MATCH :q
+        UNION ALL
+        SELECT 'incident', i.id, NULL, i.incident_class, i.incident_type,
+               snippet(incident_fts, -1, :start, :end, '…', 16),
+               -bm25(incident_fts)
+        FROM incident_fts
+        JOIN incident i ON i.id = incident_fts.rowid
+        WHERE incident_fts MATCH :q
+        ORDER BY score DESC
+        LIMIT :limit OFFSET :offset
+    """, """
+        SELECT (SELECT count(*) FROM incident_step_fts WHERE incident_step_fts MATCH :q)
+             + (SELECT count(*) FROM incident_fts WHERE incident_fts MATCH :q)
+    """),
+    'postgresql': (tsquery_match_query, f"""
+        SELECT 'step' AS source, s.incident_id AS incident_id, s.step_index AS step_index,
+               i.incident_class AS incident_class, i.incident_type AS incident_type,
+               ts_headline('simple', concat_ws(' ', {', '.join('s.' + c for c in STEP_TEXT_COLUMNS)}), q,
+                           'StartSel=' || :start || ', StopSel=' || :end || ', MaxWords=16, MinWords=5') AS snippet,
+               ts_rank({history_tsvector('s', STEP_TEXT_COLUMNS)}, q) AS score
+        FROM incident_step s
+        JOIN incident i ON i.id = s.incident_id
+        CROSS JOIN to_tsquery('simple', :q) q
+        WHERE {history_tsvector('s', STEP_TEXT_COLUMNS)} @@ q
+        UNION ALL
+        SELECT 'incident', i.id, NULL, i.incident_class, i.incident_type,
+               ts_headline('simple', concat_ws(' ', {', '.join('i.' + c for c in INCIDENT_TEXT_COLUMNS)}), q,
+                           'StartSel=' || :start || ', StopSel=' || :end || ', MaxWords=16, MinWords=5'),
+               ts_rank({history_tsvector('i', INCIDENT_TEXT_COLUMNS)}, q)
+        FROM incident i
+        CROSS JOIN to_tsquery('simple', :q) q
+        WHERE {history_tsvector('i', INCIDENT_TEXT_COLUMNS)} @@ q
+        ORDER BY score DESC
+        LIMIT :limit OFFSET :offset
+    """, f"""
+        SELECT (SELECT count(*) FROM incident_step s
+                WHERE {history_tsvector('s', STEP_TEXT_COLUMNS)} @@ to_tsquery('simple', :q))
+             + (SELECT count(*) FROM incident i
+                WHERE {history_tsvector('i', INCIDENT_TEXT_COLUMNS)} @@ to_tsquery('simple', :q))
+    """),
+}
 
-    incidents = load_incidents()
-    steps_data = load_incident_steps()
 
-    results = []
+def render_snippet(raw):
+    escaped = html.escape(raw or '')
+    return escaped.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
 
-    if not query or len(query.strip()) < 2:
-        return jsonify({'results': []})
 
-    for incident in incidents:
-        class_name = incident.get('class', '')
-        if query in class_name.lower():
-            results.append({
-                "class": class_name
-            })
+@app.route('/search/history', methods=['GET'])
+def search_history():
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if not history_search_enabled():
+        return jsonify({'error': 'Full-text search is not available'}), 503
+
+    query = (request.args.get('q') or '').strip()
+    limit = int_arg(request.args.get('limit'), 20, 1, 100)
+    offset = int_arg(request.args.get('offset'), 0, 0)
+
+    match_query, rows_sql, count_sql = HISTORY_SEARCH_SQL[db.engine.dialect.name]
+    match = match_query(query)
+    if len(query) < 2 or not match:
+        return jsonify({'results': [], 'total': 0, 'limit': limit, 'offset': offset})
+
+    params = {'q': match, 'start': SNIPPET_START, 'end': SNIPPET_END, 'limit': limit, 'offset': offset}
+    rows = db.session.execute(text(rows_sql), params).mappings().all()
+    total = db.session.execute(text(count_sql), {'q': match}).scalar()
+
+    results = [{
+        'source': row['source'],
+        'incident_id': row['incident_id'],
+        'step_index': row['step_index'],
+        'class': row['incident_class'],
+        'type': row['incident_type'],
+        'snippet': render_snippet(row['snippet']),
+        'score': round(float(row['score']), 6)
+    } for row in rows]
+
+    return jsonify({'results': results, 'total': total, 'limit': limit, 'offset': offset})
+
+
+@app.route('/admin/playbook/reload', methods=['POST'])
+def reload_playbook():
+    if session.get('username') != 'admin':
+        return jsonify({'error': 'Forbidden'}), 403
 
-        for type_obj in incident.get('types', []):
-            type_name = type_obj.get('type', '')
-            if query in type_name.lower():
-                results.append({
-                    "class": class_name,
-                    "type": type_name
-                })
-
-
-    for entry in steps_data:
-        class_name = entry.get('class', '')
-        for type_obj in entry.get('types', []):
-            type_name = type_obj.get('type', '')
-            for step in type_obj.get('steps', []):
-                step_text = step.get('step', '')
-                if query in step_text.lower():
-                    results.append({
-                        "class": class_name,
-                        "type": type_name,
-                        "step": step_text
-                    })
-                for sub in step.get('sub_steps', []):
-                    if query in sub.lower():
-                        results.append({
-                            "class": class_name,
-                            "type": type_name,
-                            "substep": sub
-                        })
-
-    unique_results = []
-    seen = set()
-
-    for r in results:
-        key = json.dumps(r, sort_keys=True)
-        if key not in seen:
-            seen.add(key)
-            unique_results.append(r)
-
-    return jsonify({'results': unique_results})
-
-    return jsonify({'results': results})
+    try:
+        snap = playbook_catalog.reload()
+    except (OSError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    return jsonify({
+        'status': 'ok',
+        'classes': len(snap.steps),
+        'loaded_at': snap.loaded_at.isoformat()
+    })
 
 
 @app.before_request
@@ -1140,5 +3778,233 @@ def logout():
     return redirect(url_for('index'))
 
 
+def hot_queries():
+    """Queries das rotas mais usadas, para verificar os planos de execução."""
+    return [
+        ('steps by incident',
+         select(IncidentStep).where(IncidentStep.incident_id == 1)),
+        ('step by incident and index',
+         select(IncidentStep).where(IncidentStep.incident_id == 1, IncidentStep.step_index == 1)),
+        ('dashboard in progress',
+         select(Incident).where(Incident.status == 'In Progress')
+         .order_by(Incident.start_datetime.desc(), Incident.id.desc()).limit(DASHBOARD_PAGE_SIZE + 1)),
+        ('dashboard completed, next page',
+         select(Incident).where(Incident.status == 'Completed',
+                                tuple_(Incident.start_datetime, Incident.id) < tuple_(datetime(2030, 1, 1), 1000))
+         .order_by(Incident.start_datetime.desc(), Incident.id.desc()).limit(DASHBOARD_PAGE_SIZE + 1)),
+        ('dashboard by class and type',
+         select(Incident).where(Incident.incident_class == 'Malicious Code', Incident.incident_type == 'C2 Server')
+         .order_by(Incident.id).limit(DASHBOARD_PAGE_SIZE + 1)),
+        ('incidents by start date',
+         select(Incident).where(Incident.start_datetime >= datetime(2000, 1, 1)).order_by(Incident.start_datetime)),
+    ]
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Falha se alguma query quente fizer um full scan às tabelas de incidentes."""
+    dialect = db.engine.dialect.name
+    if dialect not in ('sqlite', 'postgresql'):
+        raise click.ClickException(f'check-query-plans does not support {dialect}')
+
+    if dialect == 'postgresql':
+        # Com tabelas pequenas o planner prefere Seq Scan; desligá-lo prova que há índice utilizável
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+
+    failures = 0
+    for name, stmt in hot_queries():
+        sql = str(stmt.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        if dialect == 'sqlite':
+            plan = [row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+            full_scan = [detail for detail in plan if detail.startswith('SCAN') and 'USING' not in detail]
+        else:
+            plan = [row[0].strip() for row in db.session.execute(text('EXPLAIN ' + sql))]
+            full_scan = [detail for detail in plan if 'Seq Scan' in detail]
+        status = 'FAIL' if full_scan else 'ok'
+        failures += bool(full_scan)
+        click.echo(f'[{status}] {name}: ' + ' | '.join(plan))
+
+    db.session.rollback()
+    if failures:
+        raise click.ClickException(f'{failures} hot queries are not using an index')
+
+
+@app.cli.command('rebuild-summary')
+def rebuild_summary_command():
+    """Reconstrói a tabela incident_summary a partir dos incidentes."""
+    with db.engine.begin() as connection:
+        groups = rebuild_incident_summary(connection)
+    click.echo(f'incident_summary rebuilt: {groups} groups')
+
+
+@app.cli.command('gc-blobs')
+def gc_blobs_command():
+    """Recalcula as referências dos blobs a partir dos passos e apaga os que não são usados."""
+    table = Blob.__table__
+    refs = select(func.count()).where(Attachment.sha256 == table.c.sha256).scalar_subquery()
+    db.session.execute(table.update().values(refcount=refs))
+    db.session.commit()
+    removed = blob_store.collect()
+
+    # Ficheiros em blobs/ sem linha na tabela (p.ex. uploads interrompidos)
+    known = set(db.session.execute(select(Blob.sha256)).scalars())
+    orphans = 0
+    for path in pathlib.Path(blob_store.directory).glob('??/*'):
+        if path.name not in known:
+            path.unlink(missing_ok=True)
+            orphans += 1
+    click.echo(f'blobs removed: {removed} unreferenced, {orphans} orphaned files')
+
+
+STARTUP_BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', '1000'))
+# Só os relatórios e as imagens precisam destes; o arranque não os pode importar
+LAZY_MODULES = ('fpdf', 'docxtpl', 'docx', 'lxml', 'openpyxl', 'PIL', 'uno')
+
+
+@app.cli.command('bench-sqlite')
+@click.option('--threads', default=8, show_default=True, help='Concurrent writers.')
+@click.option('--writes', default=200, show_default=True, help='Autosave-like writes per thread.')
+def bench_sqlite(threads, writes):
+    """Compara escritas/s concorrentes com o SQLite por omissão e com os PRAGMAs configurados."""
+    def run(label, pragmas):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(
+                'sqlite:///' + os.path.join(tmp, 'bench.db'),
+                pool_size=threads, max_overflow=0,
+                connect_args={'check_same_thread': False}
+            )
+            if pragmas:
+                event.listen(engine, 'connect', lambda conn, rec: apply_sqlite_pragmas(conn, rec, pragmas))
+
+            with engine.begin() as conn:
+                conn.execute(text('CREATE TABLE step (id INTEGER PRIMARY KEY, evidence TEXT, saves INTEGER)'))
+                conn.execute(text('INSERT INTO step (id, evidence, saves) VALUES (:id, \'\', 0)'),
+                             [{'id': i} for i in range(threads)])
+
+            errors = []
+
+            def writer(worker):
+                for n in range(writes):
+                    try:
+                        with engine.begin() as conn:
+                            conn.execute(text('SELECT count(*) FROM step')).scalar()
+                            conn.execute(
+                                text('UPDATE step SET evidence = :evidence, saves = saves + 1 WHERE id = :id'),
+                                {'evidence': f'evidence {worker}/{n} ' * 20, 'id': worker}
+                            )
+                    except Exception as e:
+                        errors.append(e)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(writer, range(threads)))
+            elapsed = time.perf_counter() - started
+            engine.dispose()
+
+            done = threads * writes - len(errors)
+            click.echo(f'{label:>8}: {done / elapsed:9.1f} writes/s  ({done} ok, {len(errors)} failed, {elapsed:.2f}s)')
+
+    run('default', None)
+    run('tuned', SQLITE_PRAGMAS)
+
+
+def sample_report_data(steps=8):
+    return {
+        'current_date': datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+        'incident_id': 0,
+        'selected_class': 'Malicious Code',
+        'selected_type': 'Infected System',
+        'start_time': '01/01/2024 09:00:00',
+        'end_time': '01/01/2024 17:00:00',
+        'steps': [
+            {'step': f'Step {n}', 'substeps': [f'Sub-step {n}.{m}' for m in range(1, 4)],
+             'evidence': f'Evidence for step {n}. ' * 10, 'attachments': []}
+            for n in range(1, steps + 1)
+        ],
+        'improvements': 'Improvements. ' * 20,
+        'observations': 'Observations. ' * 20
+    }
+
+
+@app.cli.command('bench-report-template')
+@click.option('--reports', default=20, show_default=True, help='Reports rendered per variant and round.')
+@click.option('--rounds', default=5, show_default=True, help='Alternating rounds (the median counts).')
+@click.option('--incident', 'incident_id', type=int, default=None, help='Use the data of this incident.')
+def bench_report_template(reports, rounds, incident_id):
+    """Tempo por relatório (DOCX, sem conversão): template lido do disco a cada vez vs. em cache."""
+    dados = build_report_data(incident_id) if incident_id else sample_report_data()
+
+    def render(load):
+        doc = load()
+        doc.render(copy.deepcopy(dados))
+        doc.save(io.BytesIO())
+
+    def run(load):
+        started = time.perf_counter()
+        for _ in range(reports):
+            render(load)
+        return (time.perf_counter() - started) / reports * 1000
+
+    from docxtpl import DocxTemplate
+
+    variants = {
+        'disk': lambda: DocxTemplate(REPORT_TEMPLATE_PATH),
+        'cached': lambda: template_cache.get(REPORT_TEMPLATE_PATH),
+    }
+    timings = {label: [] for label in variants}
+    for load in variants.values():
+        render(load)  # aquecimento
+    # Rondas alternadas: o ruído da máquina afeta as duas variantes por igual
+    for _ in range(rounds):
+        for label, load in variants.items():
+            timings[label].append(run(load))
+
+    for label, values in timings.items():
+        click.echo(f'{label:>7}: {statistics.median(values):8.1f} ms/report '
+                   f'(min {min(values):.1f}, max {max(values):.1f})')
+    cold, warm = statistics.median(timings['disk']), statistics.median(timings['cached'])
+    click.echo(f'saved {cold - warm:.1f} ms/report ({(cold - warm) / cold:.0%})')
+
+
+@app.cli.command('bench-startup')
+@click.option('--runs', default=5, show_default=True, help='Imports measured (the median counts).')
+@click.option('--budget-ms', default=STARTUP_BUDGET_MS, show_default=True, help='Maximum import time of main.')
+@click.option('--top', default=10, show_default=True, help='Slowest modules to list.')
+def bench_startup(runs, budget_ms, top):
+    """Mede o import de main com python -X importtime e falha acima do orçamento.
+
+    Também falha se algum módulo só usado pelos relatórios for importado no arranque.
+    """
+    totals = []
+    modules = {}
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                                cwd=basedir, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise click.ClickException(f'import main failed:\n{result.stderr[-2000:]}')
+        modules = {}
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            modules[name.strip()] = int(cumulative) / 1000
+        totals.append(modules.get('main', 0.0))
+
+    for name, elapsed in heapq.nlargest(top, modules.items(), key=lambda item: item[1]):
+        click.echo(f'{elapsed:9.1f} ms  {name}')
+    median = sorted(totals)[len(totals) // 2]
+    click.echo(f'import main: median {median:.1f} ms over {runs} runs (budget {budget_ms:.0f} ms)')
+
+    eager = sorted(name for name in modules if name.split('.')[0] in LAZY_MODULES)
+    if eager:
+        raise click.ClickException(f'report-only modules imported at startup: {", ".join(eager[:10])}')
+    if median > budget_ms:
+        raise click.ClickException(f'startup over budget: {median:.1f} ms > {budget_ms:.0f} ms')
+
+
 if __name__ == '__main__':
+    # Em desenvolvimento o esquema é preparado aqui; em produção corre-se `flask init-db`
+    with app.app_context():
+        init_db()
     app.run(debug=True)
@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# A aplicação lê a configuração ao importar: base de dados temporária e sessões em cookie.
+# TEST_DATABASE_URL corre a suite noutro motor (ex.: postgresql+embedded://); nunca se usa
+# o DATABASE_URL do ambiente, que pode ser a base de dados real.
+TEST_DIR = tempfile.mkdtemp(prefix='incident-tests-')
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL') or 'sqlite:///' + os.path.join(TEST_DIR, 'test.db')
+os.environ.setdefault('SESSION_TYPE', 'cookie')
+os.environ.setdefault('EMBEDDED_PGDATA', os.path.join(TEST_DIR, 'pgdata'))
+os.environ.setdefault('PDF_FONT_CACHE_DIR', os.path.join(TEST_DIR, 'fpdf_cache'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'postgres: corre a suite contra um PostgreSQL embebido (pgserver)')
+
+
+@pytest.fixture
+def app():
+    main.app.config['TESTING'] = True
+    with main.app.app_context():
+        main.init_db()
+        yield main.app
+        main.db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def incident(app):
+    """Incidente com um playbook de 10 passos e o passo 1 criado."""
+    playbook = [{'title': f'Step {index}', 'sub_steps': ['a']} for index in range(1, 11)]
+    incident = main.Incident(incident_class='Test', incident_type='Test', status='In Progress',
+                             steps=main.json.dumps(playbook), total_steps=len(playbook))
+    main.db.session.add(incident)
+    main.db.session.flush()
+    main.db.session.add(main.IncidentStep(incident_id=incident.id, step_index=1))
+    main.db.session.commit()
+    return incident
@@ -0,0 +1,61 @@
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def database_env(monkeypatch):
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    monkeypatch.delenv('SQLALCHEMY_DATABASE_URI', raising=False)
+    return monkeypatch
+
+
+def test_default_is_the_sqlite_file(database_env):
+    assert main.resolve_database_uri() == main.DEFAULT_DATABASE_URI
+
+
+def test_heroku_style_postgres_scheme_is_normalized(database_env):
+    database_env.setenv('DATABASE_URL', 'postgres://irp:secret@db:5432/irp')
+    assert main.resolve_database_uri() == 'postgresql://irp:secret@db:5432/irp'
+
+
+def test_embedded_postgres_uri_is_used_when_available(database_env):
+    database_env.setenv('DATABASE_URL', 'postgresql+embedded://')
+    database_env.setattr(main, 'start_embedded_postgres', lambda: 'postgresql://postgres@/postgres?host=/tmp/pg')
+    assert main.resolve_database_uri() == 'postgresql://postgres@/postgres?host=/tmp/pg'
+
+
+def test_embedded_postgres_falls_back_to_sqlite(database_env):
+    database_env.setenv('DATABASE_URL', 'postgresql+embedded://')
+    database_env.setattr(main, 'start_embedded_postgres', lambda: None)
+    assert main.resolve_database_uri() == main.DEFAULT_DATABASE_URI
+
+
+def test_engine_options_per_backend():
+    assert main.engine_options('sqlite://') == {'connect_args': {'check_same_thread': False}}
+
+    sqlite_file = main.engine_options('sqlite:////srv/irp/database.db')
+    assert sqlite_file['connect_args']['timeout'] == main.SQLITE_PRAGMAS['busy_timeout'] / 1000.0
+    assert 'pool_pre_ping' not in sqlite_file
+
+    postgres = main.engine_options('postgresql+psycopg://irp@db/irp')
+    assert postgres['pool_pre_ping'] is True
+    assert postgres['pool_recycle'] == int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+    assert 'connect_args' not in postgres
+
+
+@pytest.mark.postgres
+@pytest.mark.skipif(importlib.util.find_spec('pgserver') is None, reason='pgserver not installed')
+def test_suite_passes_on_embedded_postgres(tmp_path):
+    if os.environ.get('TEST_DATABASE_URL'):
+        pytest.skip('the suite is already running against TEST_DATABASE_URL')
+    env = dict(os.environ, TEST_DATABASE_URL='postgresql+embedded://', EMBEDDED_PGDATA=str(tmp_path / 'pgdata'))
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-m', 'pytest', '-q', '-m', 'not postgres', tests_dir],
+                            env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout[-3000:]
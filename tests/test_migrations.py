@@ -0,0 +1,52 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+import main
+
+# Esquema da versão inicial: os passos guardavam a classe, o tipo e o snapshot do playbook
+BASELINE_SCHEMA = """
+CREATE TABLE incident (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, incident_class VARCHAR(100), incident_type VARCHAR(100),
+    steps TEXT, sub_steps TEXT, evidence TEXT, attachments TEXT, upload_status BOOLEAN,
+    creation_date DATETIME, status VARCHAR(50), improvements TEXT, observations TEXT,
+    start_datetime DATETIME, end_datetime DATETIME
+);
+CREATE TABLE incident_step (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, incident_id INTEGER NOT NULL REFERENCES incident (id),
+    steps VARCHAR(100), step_index INTEGER, incident_class VARCHAR(100), incident_type VARCHAR(100),
+    evidence TEXT, sub_steps TEXT, attachment_name VARCHAR(255), upload_status BOOLEAN,
+    start_datetime DATETIME, improvements TEXT, observations TEXT, percent_complete FLOAT,
+    status VARCHAR(50)
+);
+"""
+
+
+def test_progress_follows_the_snapshot_not_the_catalog(tmp_path):
+    incident_class, incident_type = 'Malicious Code', 'Infected System'
+    catalog_steps = main.playbook_catalog.lookup(incident_class, incident_type).step_count
+    snapshot = json.dumps(['Isolate', 'Collect', 'Eradicate'])
+    assert catalog_steps != 3
+
+    path = tmp_path / 'legacy.db'
+    with sqlite3.connect(path) as legacy:
+        legacy.executescript(BASELINE_SCHEMA)
+        legacy.execute("INSERT INTO incident (id, incident_class, incident_type, status, start_datetime) "
+                       "VALUES (1, ?, ?, 'In Progress', '2024-01-01 09:00:00')", (incident_class, incident_type))
+        legacy.executemany(
+            "INSERT INTO incident_step (incident_id, steps, step_index, incident_class, incident_type, evidence, "
+            "sub_steps, attachment_name, start_datetime) VALUES (1, ?, ?, ?, ?, 'done', '[\"a\"]', ?, "
+            "'2024-01-01 09:00:00')",
+            [(snapshot, index, incident_class, incident_type, f'uploads/1/step_{index}/missing.txt')
+             for index in (1, 2, 3)]
+        )
+
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}')
+    subprocess.run([sys.executable, '-c', 'import main\nwith main.app.app_context(): main.init_db()'],
+                   cwd=os.path.dirname(main.__file__), env=env, check=True, capture_output=True)
+
+    with sqlite3.connect(path) as migrated:
+        row = migrated.execute("SELECT total_steps, completed_steps, percent_complete FROM incident").fetchone()
+    assert row == (3, 3, 50.0)
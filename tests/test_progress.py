@@ -0,0 +1,32 @@
+import json
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+import main
+
+
+def test_saving_same_step_twice_counts_once(client, incident):
+    step = main.IncidentStep.query.filter_by(incident_id=incident.id, step_index=1).one()
+    main.db.session.add(main.Attachment(incident_id=incident.id, step_id=step.id, step_index=1,
+                                        filename='proof.txt', path='uploads/proof.txt'))
+    main.db.session.commit()
+
+    with client.session_transaction() as sess:
+        sess['username'] = 'tester'
+        sess['incident_id'] = incident.id
+    payload = {'step': 1, 'evidence': 'logs collected', 'sub_steps': ['a']}
+    response = client.post('/incident/save_step', data=json.dumps(payload), content_type='application/json')
+    assert response.status_code == 200
+
+    # Segundo save concorrente: leu o passo antes de o primeiro o concluir
+    stale = main.db.session.get(main.IncidentStep, step.id)
+    set_committed_value(stale, 'completed', False)
+    stale.evidence = 'logs collected'
+    stale.sub_steps = json.dumps(['a'])
+    assert main.sync_step_completion(stale) is None
+    main.db.session.commit()
+
+    completed = main.db.session.execute(
+        main.select(main.Incident.completed_steps).where(main.Incident.id == incident.id)
+    ).scalar()
+    assert completed == 1
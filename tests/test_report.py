@@ -0,0 +1,58 @@
+import os
+
+import main
+
+
+def report_data(description):
+    return {
+        'incident_id': 1, 'selected_class': 'Malware', 'selected_type': 'Ransomware 🔒',
+        'current_date': '18/10/2026', 'start_time': '10:00', 'end_time': '11:00',
+        'steps': [{'step': 'Contain 🚨', 'substeps': ['Isolate host'], 'evidence': description,
+                   'attachments': []}],
+        'improvements': 'None', 'observations': description,
+    }
+
+
+def test_pdf_report_renders_characters_outside_the_font(tmp_path):
+    output = tmp_path / 'report.pdf'
+    main.render_report_pdf(report_data('Host encrypted 😱 — 中文 notes'), str(output), engine='fpdf')
+    assert output.read_bytes().startswith(b'%PDF')
+
+
+def test_font_metrics_are_cached_outside_the_font_dir(tmp_path):
+    before = set(os.listdir(main.PDF_FONT_DIR))
+    main.render_report_pdf(report_data('Host encrypted'), str(tmp_path / 'report.pdf'), engine='fpdf')
+    assert set(os.listdir(main.PDF_FONT_DIR)) == before
+    assert any(name.endswith('.pkl') for name in os.listdir(main.PDF_FONT_CACHE_DIR))
+
+
+def test_missing_glyphs_become_placeholders():
+    pdf = main.report_pdf_class()(report_data(''))
+    pdf.add_page()
+    pdf.set_font('OktahLight', '', 10)
+    assert pdf.normalize_text('ok 😱\n') == f'ok {main.PDF_MISSING_GLYPH}\n'
+
+
+def test_cache_key_does_not_depend_on_install_path(monkeypatch):
+    keys = set()
+    for root in ('/srv/irp', '/opt/irp-copy'):
+        monkeypatch.setattr(main, 'basedir', root)
+        dados = report_data('Host encrypted')
+        dados['steps'][0]['attachments'] = [f'{root}/uploads/1/step_1/proof.png']
+        dados['steps'][0]['attachment_digests'] = ['ab' * 32]
+        keys.add(main.report_cache_key(dados, 'fpdf'))
+    assert len(keys) == 1
+
+
+def test_job_status_answers_without_waiting(client, incident):
+    job = main.ReportJob(incident_id=incident.id, engine='fpdf', output_path='reports/pending.pdf')
+    main.db.session.add(job)
+    main.db.session.commit()
+    with client.session_transaction() as sess:
+        sess['username'] = 'tester'
+
+    started = main.time.monotonic()
+    response = client.get(f'/reports/jobs/{job.id}?wait=25')
+    assert response.status_code == 200
+    assert response.json['status'] == 'queued'
+    assert main.time.monotonic() - started < 1
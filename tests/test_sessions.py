@@ -0,0 +1,23 @@
+import main
+
+
+def server_session_client(app, tmp_path):
+    store = main.FilesystemSessionStore(str(tmp_path / 'flask_session'))
+    app.session_interface = main.ServerSessionInterface(store)
+    return app.test_client(), store
+
+
+def test_anonymous_requests_do_not_persist_sessions(app, tmp_path):
+    original = app.session_interface
+    try:
+        client, store = server_session_client(app, tmp_path)
+        response = client.get('/.well-known/appspecific/com.chrome.devtools.json')
+        assert response.status_code == 200
+        assert 'Set-Cookie' not in response.headers
+        assert not (tmp_path / 'flask_session').exists()
+
+        with client.session_transaction() as sess:
+            sess['username'] = 'tester'
+        assert len(list((tmp_path / 'flask_session').iterdir())) == 1
+    finally:
+        app.session_interface = original
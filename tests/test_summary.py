@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+import main
+
+
+def test_completion_keeps_start_and_closes_in_utc(client, incident, monkeypatch):
+    # O relatório fica só em fila: os workers não arrancam no teste
+    monkeypatch.setattr(main.report_queue, 'start', lambda: None)
+    monkeypatch.setattr(main.report_queue, 'notify', lambda: None)
+    start = main.db.session.get(main.Incident, incident.id).start_datetime
+    with client.session_transaction() as sess:
+        sess['username'] = 'tester'
+        sess['incident_id'] = incident.id
+        sess['start'] = (start - timedelta(days=3)).isoformat()
+    response = client.post('/save_completion', json={'improvements': 'More logging', 'observations': 'None',
+                                                     'engine': 'fpdf'})
+    assert response.status_code == 200
+
+    main.db.session.expire_all()
+    completed = main.db.session.get(main.Incident, incident.id)
+    assert completed.start_datetime == start
+    assert abs(completed.end_datetime - datetime.utcnow()) < timedelta(minutes=1)
+
+
+def test_end_before_start_is_counted_apart_from_mean_time_to_close(app):
+    start = datetime(2026, 1, 1, 12, 0)
+    main.db.session.add_all([
+        main.Incident(incident_class='Legacy', incident_type='Clock skew', status='Completed',
+                      start_datetime=start, end_datetime=start - timedelta(hours=30)),
+        main.Incident(incident_class='Legacy', incident_type='Clock skew', status='Completed',
+                      start_datetime=start, end_datetime=start + timedelta(hours=2)),
+    ])
+    main.db.session.commit()
+
+    with main.db.engine.begin() as connection:
+        main.rebuild_incident_summary(connection)
+    row = main.db.session.execute(
+        main.select(main.IncidentSummary).where(main.IncidentSummary.incident_class == 'Legacy')
+    ).scalar_one()
+    assert (row.incident_count, row.closed_count, row.close_seconds, row.invalid_dates_count) == (2, 1, 7200.0, 1)
+    assert main.dashboard_kpis()['invalid_dates'] >= 1
+
+
+def test_format_duration_handles_missing_and_negative_values():
+    assert main.format_duration(None) == '—'
+    assert main.format_duration(-3600) == '—'
+    assert main.format_duration(93600) == '1d 2h'
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def upload_client(client, incident, tmp_path, monkeypatch):
+    # Ficheiros do teste fora da árvore do projeto
+    monkeypatch.setattr(main.app, 'root_path', str(tmp_path))
+    monkeypatch.setattr(main, 'UPLOAD_PARTIAL_DIR', str(tmp_path / 'upload_parts'))
+    monkeypatch.setattr(main, 'blob_store', main.BlobStore(str(tmp_path / 'blobs')))
+    monkeypatch.setattr(main, 'generate_derivatives', lambda path: {})
+    with client.session_transaction() as sess:
+        sess['username'] = 'tester'
+        sess['incident_id'] = incident.id
+    return client
+
+
+def put_chunk(client, upload, data, start, end):
+    return client.put(upload['url'], data=data[start:end + 1],
+                      headers={'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+
+def open_upload(client, data):
+    return client.post('/incident/uploads', json={'step': 1, 'filename': 'dump.bin', 'size': len(data)})
+
+
+def test_upload_resumes_after_an_interruption(upload_client, tmp_path):
+    data = os.urandom(3000)
+    upload = open_upload(upload_client, data).json
+
+    assert put_chunk(upload_client, upload, data, 0, 999).status_code == 200
+    # A ligação cai a meio do segundo bloco: só parte dele chega ao servidor
+    response = upload_client.put(upload['url'], data=data[1000:1500],
+                                 headers={'Content-Range': f'bytes 1000-1999/{len(data)}'})
+    assert response.status_code == 400
+
+    resumed = open_upload(upload_client, data)
+    assert resumed.status_code == 200
+    assert resumed.json['id'] == upload['id']
+    offset = resumed.json['offset']
+    assert offset == 1000
+
+    response = put_chunk(upload_client, upload, data, offset, len(data) - 1)
+    assert response.json['status'] == 'success'
+    assert (tmp_path / response.json['file']).read_bytes() == data
+    assert not os.listdir(tmp_path / 'upload_parts')
+
+
+def test_failed_completion_keeps_the_upload_for_a_retry(upload_client, tmp_path, monkeypatch):
+    data = os.urandom(2000)
+    upload = open_upload(upload_client, data).json
+    assert put_chunk(upload_client, upload, data, 0, 999).status_code == 200
+
+    attach = main.attach_step_file
+
+    def failing_attach(*args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(main, 'attach_step_file', failing_attach)
+    assert put_chunk(upload_client, upload, data, 1000, 1999).status_code == 500
+    assert upload_client.get(upload['url']).json['offset'] == len(data)
+
+    # Repetir a conclusão não reenvia o ficheiro
+    monkeypatch.setattr(main, 'attach_step_file', attach)
+    response = open_upload(upload_client, data)
+    assert response.json['status'] == 'success'
+    assert (tmp_path / response.json['file']).read_bytes() == data
+    assert upload_client.get(upload['url']).status_code == 404